@@ -0,0 +1,295 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+from storage import atomic_write
+
+logger = logging.getLogger(__name__)
+
+# Event kinds
+START = "start"
+BUTTON = "button"
+DELIVERED = "delivered"
+FAILED = "failed"
+# What the event's detail is called in the event files
+DETAIL_KEYS = {START: "new", BUTTON: "button", DELIVERED: "job", FAILED: "job"}
+
+# Default write-behind tuning (overridable from config.py)
+FLUSH_INTERVAL = 5.0
+FLUSH_BATCH = 1000
+# Rewrite the rollup snapshot after this many events have been appended
+SNAPSHOT_EVERY = 10000
+# Rollups kept in memory (and in the snapshot)
+DAYS_KEPT = 90
+HOURS_KEPT = 48
+
+# One reusable encoder; json.dumps with options builds a new one per call
+encode_event = json.JSONEncoder(ensure_ascii=False).encode
+
+
+def new_bucket():
+    """Counters of one day or hour"""
+    return {"active_users": 0, "new_users": 0, "starts": 0, "buttons": {}, "delivered": 0, "failed": 0}
+
+
+class Analytics:
+    """Append-only stream of user events, with daily and hourly rollups
+
+    Events (/start, menu button presses, mailing deliveries and failures)
+    are buffered and appended in batches to one JSON Lines file per UTC
+    day under events/. Each event also updates the rollups of its day and
+    hour as it arrives: active users (distinct users who sent /start or
+    pressed a button), new users, starts, presses per button, mailing
+    messages delivered and failed. /stats reads the rollups and never
+    touches the event files.
+
+    The rollups are saved to analytics.json together with the position in
+    the event files they cover. Loading reads that and replays the events
+    appended after it, like the user registry's snapshot and log.
+    """
+
+    def __init__(self, data_dir, tz=timezone.utc, flush_interval=FLUSH_INTERVAL,
+                 flush_batch=FLUSH_BATCH, snapshot_every=SNAPSHOT_EVERY):
+        self.events_dir = os.path.join(data_dir, "events")
+        self.snapshot_path = os.path.join(data_dir, "analytics.json")
+        # Days and hours are counted in this time zone
+        self.tz = tz
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self.snapshot_every = snapshot_every
+        # "YYYY-MM-DD" / "YYYY-MM-DD HH" -> bucket (see new_bucket)
+        self.days = {}
+        self.hours = {}
+        # Distinct active users of the latest day and hour seen
+        self._day, self._day_users = None, set()
+        self._hour, self._hour_users = None, set()
+        # Hour the last event fell in, so most events skip the calendar math
+        self._hour_start = self._hour_end = 0.0
+        self._hour_keys = None
+        # (unix time, kind, user ID, detail) not written yet
+        self._pending = []
+        # Event file and offset the saved rollups cover
+        self._position = (None, 0)
+        self._since_snapshot = 0
+        # Guards rollups and pending events against the flush running in a worker thread
+        self._lock = threading.Lock()
+        # Serializes flushes so appends and snapshots never interleave
+        self._flush_lock = threading.Lock()
+        self._flush_wanted = asyncio.Event()
+        self._task = None
+
+    def _keys(self, ts):
+        """(day key, hour key) of a unix time"""
+        if not self._hour_start <= ts < self._hour_end:
+            hour = datetime.fromtimestamp(ts, self.tz).replace(minute=0, second=0, microsecond=0)
+            self._hour_start = hour.timestamp()
+            self._hour_end = self._hour_start + 3600
+            key = hour.strftime("%Y-%m-%d %H")
+            self._hour_keys = (key[:10], key)
+        return self._hour_keys
+
+    def _active(self, user_id, day_key, hour_key, day, hour):
+        # Events come in time order, so only the latest day and hour need their user sets
+        if day_key != self._day:
+            if self._day is not None and day_key < self._day:
+                return
+            self._day, self._day_users = day_key, set()
+            self._prune(self.days, DAYS_KEPT)
+        if hour_key != self._hour:
+            if self._hour is not None and hour_key < self._hour:
+                return
+            self._hour, self._hour_users = hour_key, set()
+            self._prune(self.hours, HOURS_KEPT)
+        if user_id not in self._day_users:
+            self._day_users.add(user_id)
+            day["active_users"] += 1
+        if user_id not in self._hour_users:
+            self._hour_users.add(user_id)
+            hour["active_users"] += 1
+
+    @staticmethod
+    def _prune(buckets, keep):
+        for key in sorted(buckets)[:-keep]:
+            del buckets[key]
+
+    def _apply(self, ts, kind, user_id, detail):
+        """Update the rollups with one event"""
+        day_key, hour_key = self._keys(ts)
+        day = self.days.get(day_key)
+        if day is None:
+            day = self.days[day_key] = new_bucket()
+        hour = self.hours.get(hour_key)
+        if hour is None:
+            hour = self.hours[hour_key] = new_bucket()
+        if kind in (START, BUTTON):
+            self._active(user_id, day_key, hour_key, day, hour)
+        for bucket in (day, hour):
+            if kind == START:
+                bucket["starts"] += 1
+                if detail:
+                    bucket["new_users"] += 1
+            elif kind == BUTTON:
+                bucket["buttons"][detail] = bucket["buttons"].get(detail, 0) + 1
+            elif kind == DELIVERED:
+                bucket["delivered"] += 1
+            elif kind == FAILED:
+                bucket["failed"] += 1
+
+    def record(self, kind, user_id, detail=None):
+        """Record an event now: rollups are updated at once, the event file at the next flush
+
+        detail: for START whether the user is new, for BUTTON the button
+        label, for DELIVERED and FAILED the mailing job ID.
+        """
+        event = (time.time(), kind, user_id, detail)
+        with self._lock:
+            self._apply(*event)
+            self._pending.append(event)
+            if len(self._pending) >= self.flush_batch:
+                self._flush_wanted.set()
+
+    def summary(self, days=7):
+        """Today's and this hour's buckets and the last `days` days' buckets, newest first"""
+        day_key, hour_key = self._keys(time.time())
+        keys = sorted(key for key in self.days if key <= day_key)[-days:]
+        return {
+            "day": day_key,
+            "today": self.days.get(day_key, new_bucket()),
+            "hour": self.hours.get(hour_key, new_bucket()),
+            "days": [(key, self.days[key]) for key in reversed(keys)],
+        }
+
+    def _state(self):
+        return {
+            "days": self.days,
+            "hours": self.hours,
+            "day": self._day,
+            "day_users": list(self._day_users),
+            "hour": self._hour,
+            "hour_users": list(self._hour_users),
+        }
+
+    def load(self):
+        """Read the saved rollups, then replay the events appended after them"""
+        os.makedirs(self.events_dir, exist_ok=True)
+        try:
+            with open(self.snapshot_path, encoding='utf-8') as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            saved = None
+        except (OSError, ValueError) as e:
+            logger.error("Could not read %s, rebuilding rollups from the event files: %s", self.snapshot_path, e)
+            saved = None
+        if saved:
+            state = saved["state"]
+            self.days, self.hours = state["days"], state["hours"]
+            self._day, self._day_users = state["day"], set(state["day_users"])
+            self._hour, self._hour_users = state["hour"], set(state["hour_users"])
+            self._position = (saved["file"], saved["offset"])
+        start_file, start_offset = self._position
+        replayed = 0
+        for name in sorted(os.listdir(self.events_dir)):
+            if start_file is not None and name < start_file:
+                continue
+            offset = start_offset if name == start_file else 0
+            with open(os.path.join(self.events_dir, name), 'rb') as f:
+                f.seek(offset)
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        kind = entry["event"]
+                        self._apply(entry["ts"], kind, entry["user_id"], entry.get(DETAIL_KEYS[kind]))
+                    except (ValueError, KeyError):
+                        # A line cut short by a crash
+                        continue
+                    replayed += 1
+                offset = f.tell()
+            self._position = (name, offset)
+        self._since_snapshot = replayed
+        logger.info("Loaded analytics rollups (%s days, %s events replayed)", len(self.days), replayed)
+
+    @staticmethod
+    def _line(event):
+        ts, kind, user_id, detail = event
+        entry = {"ts": round(ts, 3), "event": kind, "user_id": user_id}
+        if detail is not None:
+            entry[DETAIL_KEYS[kind]] = detail
+        return encode_event(entry) + "\n"
+
+    def flush(self, save=False):
+        """Append pending events to the event files
+
+        The rollups are saved as well every snapshot_every events, or
+        whenever there is something unsaved if save is true.
+        """
+        with self._flush_lock:
+            with self._lock:
+                events = self._pending
+                self._pending = []
+                unsaved = self._since_snapshot + len(events)
+                # Taken together with the events, so the saved rollups match the files exactly
+                state = None
+                if unsaved and (save or unsaved >= self.snapshot_every):
+                    state = json.dumps(self._state(), ensure_ascii=False)
+            if not events and state is None:
+                return False
+            # One file per UTC day; events are in time order, so each file gets one contiguous run
+            batches = {}
+            for event in events:
+                batches.setdefault(int(event[0] // 86400), []).append(self._line(event))
+            position = self._position
+            written = 0
+            try:
+                for day, lines in batches.items():
+                    name = time.strftime("%Y-%m-%d.jsonl", time.gmtime(day * 86400))
+                    with open(os.path.join(self.events_dir, name), 'a', encoding='utf-8') as f:
+                        f.write("".join(lines))
+                        position = (name, f.tell())
+                    written += len(lines)
+            except OSError as e:
+                # Days not written go back in front of the queue for the next flush
+                logger.error("Could not append analytics events, will retry: %s", e)
+                with self._lock:
+                    self._pending = events[written:] + self._pending
+                self._position = position
+                self._since_snapshot += written
+                return False
+            self._position = position
+            self._since_snapshot = unsaved
+            if state is not None:
+                snapshot = f'{{"file": {json.dumps(position[0])}, "offset": {position[1]}, "state": {state}}}'
+                try:
+                    atomic_write(self.snapshot_path, snapshot.encode('utf-8'))
+                    self._since_snapshot = 0
+                except OSError as e:
+                    logger.error("Could not save %s: %s", self.snapshot_path, e)
+        return True
+
+    async def _run_flusher(self):
+        """Background task: flush pending events on a timer or batch threshold"""
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_wanted.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_wanted.clear()
+            try:
+                await asyncio.to_thread(self.flush)
+            except Exception:
+                logger.exception("Analytics flush failed")
+
+    async def open(self):
+        """Load the rollups and start the background flusher"""
+        await asyncio.to_thread(self.load)
+        self._task = asyncio.create_task(self._run_flusher())
+
+    async def close(self):
+        """Stop the flusher, flush pending events and save the rollups"""
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await asyncio.to_thread(self.flush, True)
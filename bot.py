@@ -1,15 +1,38 @@
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton, ReplyKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
+from telegram.ext import Application, CallbackQueryHandler, CommandHandler, MessageHandler, TypeHandler, filters, ContextTypes
+from telegram.error import BadRequest
+import asyncio
+import importlib.util
 import logging
-import json
 import os
+import tempfile
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
 from config import BOT_TOKEN, TELEGRAM_CHANNEL, FREE_SPIN_URL, FREE_CREDIT_URL, FREE_SPIN_IMAGE_PATH, HOT_GAME_TIPS_IMAGE_PATH
-
-# Configure logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+from config import USER_FLUSH_INTERVAL, USER_FLUSH_BATCH, ANALYTICS_FLUSH_INTERVAL, ANALYTICS_FLUSH_BATCH, USER_RATE_LIMIT, USER_RATE_BURST, USER_DEDUP_WINDOW
+from config import BROADCAST_RATE, BROADCAST_WORKERS, BROADCAST_PROGRESS_INTERVAL, MAILING_TIMEZONE, PROMO_WARMUP_CHAT_ID
+from config import BOT_API_POOL_SIZE, BOT_API_HTTP2, BOT_API_CONNECT_TIMEOUT, BOT_API_READ_TIMEOUT
+from config import BOT_API_WRITE_TIMEOUT, BOT_API_POOL_TIMEOUT, MAX_CONCURRENT_UPDATES, SHUTDOWN_TIMEOUT, METRICS_PORT, METRICS_LISTEN, LOG_FORMAT, LOG_LEVEL
+from config import BOT_MODE, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_LISTEN, PORT, BOT_API_BASE_URL
+from storage import open_storage
+from analytics import Analytics, BUTTON, START
+from broadcast import Broadcaster
+from broadcast_jobs import JobManager
+from flood_control import FloodGuard
+from router import MessageRouter
+from export import EXPORT_FORMATS, export_users
+from mailing import MailingError, MailingOptions, MailingPipeline
+from media_cache import FileIdCache
+from webhook import run_webhook
+from lifecycle import ShutdownDeadline, run_polling
+from update_processor import PerChatUpdateProcessor
+from httpserver import HTTPServer
+import metrics
+from metrics import observe_handler, InstrumentedRequest
+from logging_config import setup_logging
+
+# Configure logging (written to stdout by a background thread, see logging_config.py)
+setup_logging(LOG_LEVEL, LOG_FORMAT)
 logger = logging.getLogger(__name__)
 
 # File to store user statistics
@@ -17,114 +40,141 @@ logger = logging.getLogger(__name__)
 DATA_DIR = os.getenv("DATA_DIR", "/data")
 # Ensure data directory exists
 os.makedirs(DATA_DIR, exist_ok=True)
+# Storage backend: "file" (append-only log + admins.json) or "sqlite" (DATA_DIR/rolex9.db)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "file")
 
-STATS_FILE = os.path.join(DATA_DIR, "user_stats.json")
-ADMINS_FILE = os.path.join(DATA_DIR, "admins.json")  # File to store admin list
+STATS_FILE = os.path.join(DATA_DIR, "user_stats.json")  # Legacy format, migrated on first boot
 
 
-def load_user_stats():
-    """Load user statistics from file"""
-    if os.path.exists(STATS_FILE):
-        try:
-            with open(STATS_FILE, 'r') as f:
-                data = json.load(f)
-                # Ensure users is a list
-                if "users" in data and isinstance(data["users"], list):
-                    return data
-                return {"users": []}
-        except (json.JSONDecodeError, IOError):
-            return {"users": []}
-    return {"users": []}
-
-
-def save_user_stats(stats):
-    """Save user statistics to file"""
-    # Convert set to list for JSON serialization
-    stats_to_save = {"users": list(stats["users"])}
-    with open(STATS_FILE, 'w') as f:
-        json.dump(stats_to_save, f)
-
-
-def add_user(user_id):
+# Storage backend for users and admins (see storage.py / sqlite_storage.py)
+storage = open_storage(
+    STORAGE_BACKEND,
+    DATA_DIR,
+    legacy_json=STATS_FILE,
+    flush_interval=USER_FLUSH_INTERVAL,
+    flush_batch=USER_FLUSH_BATCH
+)
+
+# "/mailing at 18:30" is read in this zone; UTC needs no tz database
+mailing_tz = timezone.utc if MAILING_TIMEZONE == "UTC" else ZoneInfo(MAILING_TIMEZONE)
+# Event stream and daily/hourly rollups behind /stats (days in the mailing time zone)
+analytics = Analytics(
+    DATA_DIR, tz=mailing_tz, flush_interval=ANALYTICS_FLUSH_INTERVAL, flush_batch=ANALYTICS_FLUSH_BATCH
+)
+
+# Shared by every mailing so concurrent broadcasts still respect Telegram's global limit
+broadcaster = Broadcaster(rate=BROADCAST_RATE, workers=BROADCAST_WORKERS)
+# Mailings are persisted as jobs so they survive restarts without double-sending
+job_manager = JobManager(
+    os.path.join(DATA_DIR, "broadcasts"), broadcaster, storage, progress_interval=BROADCAST_PROGRESS_INTERVAL,
+    analytics=analytics
+)
+# Both /mailing and forwarded posts go through this pipeline
+mailing_pipeline = MailingPipeline(storage, job_manager, BROADCAST_RATE)
+# Telegram file_ids of the promo images, so each image is uploaded only once
+file_id_cache = FileIdCache(os.path.join(DATA_DIR, "file_ids.json"))
+PROMO_IMAGES = [FREE_SPIN_IMAGE_PATH, HOT_GAME_TIPS_IMAGE_PATH]
+
+# Mailing progress, computed when /metrics is scraped
+metrics.gauge("bot_broadcast_jobs_running", "Mailing jobs currently sending").set_function(job_manager.running_count)
+metrics.gauge("bot_broadcast_jobs_waiting", "Mailing jobs queued or scheduled").set_function(job_manager.waiting_count)
+metrics.gauge("bot_broadcast_pending_recipients", "Recipients still waiting in running mailing jobs").set_function(
+    job_manager.pending_count
+)
+# Time left for each shutdown step once a stop signal arrives (see lifecycle.py)
+shutdown_deadline = ShutdownDeadline(SHUTDOWN_TIMEOUT)
+# Seconds of the shutdown deadline kept for flushing after mailings are stopped
+FLUSH_RESERVE = 3.0
+# Serves GET /metrics when METRICS_PORT is set
+metrics_server = HTTPServer()
+metrics_server.route("GET", "/metrics", metrics.handle_metrics)
+
+
+async def add_user(user_id):
     """Add user to statistics"""
-    stats = load_user_stats()
-    # Use set to avoid duplicates, then convert back to list
-    users_set = set(stats["users"])
-    users_set.add(user_id)
-    stats["users"] = list(users_set)
-    save_user_stats(stats)
+    return await storage.add_user(user_id)
 
 
-def get_total_users():
+async def get_total_users():
     """Get total number of users"""
-    stats = load_user_stats()
-    # Remove duplicates using set, then return count
-    return len(set(stats["users"]))
+    return await storage.count_users()
+
+
+async def get_active_users():
+    """Get number of users that can still be reached"""
+    return await storage.count_active_users()
 
 
 # Admin management functions
-def load_admins():
-    """Load admin list from file"""
-    if os.path.exists(ADMINS_FILE):
-        try:
-            with open(ADMINS_FILE, 'r') as f:
-                data = json.load(f)
-                if "admins" in data and isinstance(data["admins"], list):
-                    return data
-                return {"admins": []}
-        except (json.JSONDecodeError, IOError):
-            return {"admins": []}
-    return {"admins": []}
+# Serializes admin changes whose checks depend on the current list
+# ("first admin", "last admin") now that updates are handled concurrently
+admin_change_lock = asyncio.Lock()
+# Users per /data page
+DATA_PAGE_SIZE = 20
+
 
+async def load_admins():
+    """Load admin list"""
+    return {"admins": await storage.load_admins()}
 
-def save_admins(admins_data):
-    """Save admin list to file"""
-    with open(ADMINS_FILE, 'w') as f:
-        json.dump(admins_data, f)
 
+async def is_admin(user_id):
+    """Check if user is an admin (served from the backend's cached admin set)"""
+    return user_id in storage.admins
 
-def is_admin(user_id):
-    """Check if user is an admin"""
-    admins_data = load_admins()
-    return user_id in admins_data.get("admins", [])
 
+# Per-user token bucket and repeat-press dedup, applied before any handler
+flood_guard = FloodGuard(USER_RATE_LIMIT, USER_RATE_BURST, USER_DEDUP_WINDOW, is_exempt=is_admin)
 
-def add_admin(user_id):
+
+async def add_admin(user_id):
     """Add user to admin list"""
-    admins_data = load_admins()
-    admins_set = set(admins_data.get("admins", []))
-    admins_set.add(user_id)
-    admins_data["admins"] = list(admins_set)
-    save_admins(admins_data)
+    await storage.add_admin(user_id)
 
 
-def remove_admin(user_id):
+async def remove_admin(user_id):
     """Remove user from admin list"""
-    admins_data = load_admins()
-    admins_list = admins_data.get("admins", [])
-    if user_id in admins_list:
-        admins_list.remove(user_id)
-        admins_data["admins"] = admins_list
-        save_admins(admins_data)
-        return True
-    return False
+    return await storage.remove_admin(user_id)
 
 
+async def reply_promo(message, image_path, text, reply_markup):
+    """Reply with a promo image (by cached file_id when possible), or text only if the image is missing"""
+    key = file_id_cache.key(image_path)
+    if key is None:
+        await message.reply_text(text, reply_markup=reply_markup)
+        return
+    
+    file_id = file_id_cache.get(key)
+    if file_id:
+        try:
+            await message.reply_photo(photo=file_id, caption=text, reply_markup=reply_markup)
+            return
+        except BadRequest as e:
+            # e.g. the bot token changed and the file_id belongs to another bot
+            logger.warning("Cached file_id for %s rejected, uploading again: %s", image_path, e)
+            await asyncio.to_thread(file_id_cache.forget, key)
+    
+    with open(image_path, 'rb') as photo:
+        sent = await message.reply_photo(photo=photo, caption=text, reply_markup=reply_markup)
+    await asyncio.to_thread(file_id_cache.put, key, sent.photo[-1].file_id)
+
+
+# Menu buttons: each handler below is registered with its keyboard label
+menu = MessageRouter()
+
+
+@observe_handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /start command - show main menu"""
     user = update.effective_user
-    logger.info(f"User {user.id} ({user.username}) started the bot")
+    logger.info("User %s (%s) started the bot", user.id, user.username, extra={"user_id": user.id})
     
     # Add user to statistics
-    add_user(user.id)
+    is_new = await add_user(user.id)
+    analytics.record(START, user.id, is_new)
     
     # Create custom keyboard (bottom buttons) - only menu options
-    keyboard = [
-        [
-            KeyboardButton(text="GET FREE SPIN ON ROLEX9 🎰"),
-            KeyboardButton(text="HOT GAME TIPS CHANNEL 🍒")
-        ]
-    ]
+    keyboard = [[KeyboardButton(text=label) for label in menu.buttons]]
     reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
     
     # Send keyboard buttons only
@@ -134,6 +184,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
+@menu.button("GET FREE SPIN ON ROLEX9 🎰", "GET FREE SPIN")
+@observe_handler
 async def handle_get_free_spin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle GET FREE SPIN button click"""
     promo_text = """🎖 ROLEX9 Welcomes You to The Pinnacle of Online Gaming.
@@ -153,17 +205,11 @@ async def handle_get_free_spin(update: Update, context: ContextTypes.DEFAULT_TYP
     inline_markup = InlineKeyboardMarkup(inline_keyboard)
     
     # Send image if file exists, otherwise send text only
-    if os.path.exists(FREE_SPIN_IMAGE_PATH):
-        with open(FREE_SPIN_IMAGE_PATH, 'rb') as photo:
-            await update.message.reply_photo(
-                photo=photo,
-                caption=promo_text,
-                reply_markup=inline_markup
-            )
-    else:
-        await update.message.reply_text(promo_text, reply_markup=inline_markup)
+    await reply_promo(update.message, FREE_SPIN_IMAGE_PATH, promo_text, inline_markup)
 
 
+@menu.button("HOT GAME TIPS CHANNEL 🍒", "HOT GAME TIPS")
+@observe_handler
 async def handle_hot_game_tips(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle HOT GAME TIPS CHANNEL button click"""
     channel_text = """ROLEX9: Big Rewards. No Nonsense. 🎉
@@ -184,39 +230,17 @@ async def handle_hot_game_tips(update: Update, context: ContextTypes.DEFAULT_TYP
     inline_markup = InlineKeyboardMarkup(inline_keyboard)
     
     # Send image if file exists, otherwise send text only
-    if os.path.exists(HOT_GAME_TIPS_IMAGE_PATH):
-        with open(HOT_GAME_TIPS_IMAGE_PATH, 'rb') as photo:
-            await update.message.reply_photo(
-                photo=photo,
-                caption=channel_text,
-                reply_markup=inline_markup
-            )
-    else:
-        await update.message.reply_text(channel_text, reply_markup=inline_markup)
+    await reply_promo(update.message, HOT_GAME_TIPS_IMAGE_PATH, channel_text, inline_markup)
 
 
+@observe_handler
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle all text messages"""
-    message = update.message
-    user_id = update.effective_user.id
-    text = message.text
-    
-    # Check if admin is trying to mailing (by replying to a message or sending media)
-    # Allow admins to mailing by sending messages directly (not just forwarding)
-    if is_admin(user_id) and (message.photo or message.video or message.document or (text and len(text) > 10)):
-        # Check if this looks like a mailing message (has media or long text)
-        # But only if it's not a command or button text
-        if text and ("GET FREE SPIN" not in text.upper() and "HOT GAME TIPS" not in text.upper()):
-            # Admin is sending a message that might be for mailing
-            # Ask for confirmation or auto-mailing
-            # For now, we'll let the forwarded message handler take care of it
-            # But we can add a /mailing command later if needed
-            pass
-    
-    if "GET FREE SPIN" in text.upper():
-        await handle_get_free_spin(update, context)
-    elif "HOT GAME TIPS" in text.upper():
-        await handle_hot_game_tips(update, context)
+    # Admins mail posts by forwarding them or with /mailing, so their texts route like anyone's
+    handler = menu.resolve(update.message.text)
+    if handler:
+        analytics.record(BUTTON, update.effective_user.id, menu.labels[handler])
+        await handler(update, context)
     else:
         # Default reply
         await update.message.reply_text(
@@ -224,28 +248,65 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
 
+def format_share(part, whole):
+    return f"{100 * part / whole:.1f}%" if whole else "-"
+
+
+@observe_handler
 async def stat(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle /stat command - show user statistics"""
-    total_users = get_total_users()
-    stat_message = f"📊 **Statistics**\n\nTotal users started: {total_users}"
+    """Handle /stat command - show user statistics and today's activity from the analytics rollups"""
+    total_users = await get_total_users()
+    active_users = await get_active_users()
+    summary = analytics.summary()
+    today, hour = summary["today"], summary["hour"]
+    lines = [
+        "📊 **Statistics**\n",
+        f"Total users started: {total_users}",
+        f"Active users: {active_users}",
+        f"Inactive (blocked/deleted): {total_users - active_users}",
+        f"\n📅 **Today** ({summary['day']})",
+        f"Users active: {today['active_users']} (this hour: {hour['active_users']})",
+        f"New users: {today['new_users']} (this hour: {hour['new_users']})",
+        f"/start: {today['starts']}",
+    ]
+    # Click-through rate: presses per /start, i.e. per time the menu was shown
+    for label in menu.buttons:
+        presses = today["buttons"].get(label, 0)
+        lines.append(f"{label}: {presses} presses ({format_share(presses, today['starts'])} CTR)")
+    sent = today["delivered"] + today["failed"]
+    lines.append(
+        f"Mailings: {today['delivered']} delivered, {today['failed']} failed "
+        f"({format_share(today['delivered'], sent)} reached)"
+    )
+    lines.append("\n📈 **Last 7 days**")
+    for day, counts in summary["days"]:
+        lines.append(
+            f"{day}: {counts['active_users']} active, {counts['new_users']} new, "
+            f"{counts['delivered']} mailed"
+        )
+    stat_message = "\n".join(lines)
     await update.message.reply_text(stat_message, parse_mode='Markdown')
 
 
+@observe_handler
 async def setadmin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /setadmin command - add admin (only existing admins can add new admins)"""
     user_id = update.effective_user.id
     
     # Check if user is already an admin
-    if not is_admin(user_id):
+    if not await is_admin(user_id):
         # If no admins exist, make this user the first admin
-        admins_data = load_admins()
-        if not admins_data.get("admins", []):
-            add_admin(user_id)
+        async with admin_change_lock:
+            admins_data = await load_admins()
+            first_admin = not admins_data.get("admins", [])
+            if first_admin:
+                await add_admin(user_id)
+        if first_admin:
             await update.message.reply_text(
                 f"✅ You have been set as the first administrator!\n"
                 f"Your User ID: {user_id}"
             )
-            logger.info(f"User {user_id} became the first admin")
+            logger.info("User %s became the first admin", user_id)
             return
         else:
             await update.message.reply_text(
@@ -264,22 +325,23 @@ async def setadmin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     try:
         new_admin_id = int(context.args[0])
-        add_admin(new_admin_id)
+        await add_admin(new_admin_id)
         await update.message.reply_text(
             f"✅ User {new_admin_id} has been added as an administrator."
         )
-        logger.info(f"Admin {user_id} added new admin {new_admin_id}")
+        logger.info("Admin %s added new admin %s", user_id, new_admin_id)
     except ValueError:
         await update.message.reply_text(
             "❌ Invalid user ID. Please provide a valid number."
         )
 
 
+@observe_handler
 async def removeadmin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /removeadmin command - remove admin"""
     user_id = update.effective_user.id
     
-    if not is_admin(user_id):
+    if not await is_admin(user_id):
         await update.message.reply_text(
             "❌ Access denied. Only administrators can remove admins."
         )
@@ -296,18 +358,23 @@ async def removeadmin(update: Update, context: ContextTypes.DEFAULT_TYPE):
         admin_to_remove = int(context.args[0])
         
         # Prevent removing yourself if you're the only admin
-        admins_data = load_admins()
-        if len(admins_data.get("admins", [])) <= 1:
+        async with admin_change_lock:
+            admins_data = await load_admins()
+            if len(admins_data.get("admins", [])) <= 1:
+                removed = None
+            else:
+                removed = await remove_admin(admin_to_remove)
+        if removed is None:
             await update.message.reply_text(
                 "❌ Cannot remove the last administrator."
             )
             return
         
-        if remove_admin(admin_to_remove):
+        if removed:
             await update.message.reply_text(
                 f"✅ User {admin_to_remove} has been removed from administrators."
             )
-            logger.info(f"Admin {user_id} removed admin {admin_to_remove}")
+            logger.info("Admin %s removed admin %s", user_id, admin_to_remove)
         else:
             await update.message.reply_text(
                 f"❌ User {admin_to_remove} is not an administrator."
@@ -318,17 +385,18 @@ async def removeadmin(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
 
+@observe_handler
 async def listadmins(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /listadmins command - list all admins"""
     user_id = update.effective_user.id
     
-    if not is_admin(user_id):
+    if not await is_admin(user_id):
         await update.message.reply_text(
             "❌ Access denied. Only administrators can view the admin list."
         )
         return
     
-    admins_data = load_admins()
+    admins_data = await load_admins()
     admins_list = admins_data.get("admins", [])
     
     if not admins_list:
@@ -342,69 +410,146 @@ async def listadmins(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(admin_list_text, parse_mode='Markdown')
 
 
+async def render_data_page(offset):
+    """Text and prev/next buttons of the /data page starting at user number `offset`"""
+    admins_list = (await load_admins()).get("admins", [])
+    total_users = await get_total_users()
+    active_users = await get_active_users()
+    # Past the end (users can only be added, but the button may be old): show the last page
+    offset = max(0, min(offset, (total_users - 1) // DATA_PAGE_SIZE * DATA_PAGE_SIZE))
+    rows = await storage.user_rows(offset=offset, limit=DATA_PAGE_SIZE)
+    
+    lines = ["👑 **Admins:**"]
+    lines += [f"• `{admin_id}`" for admin_id in admins_list] or ["• No admins found"]
+    lines.append(f"\n👥 **Users (Total: {total_users}, active: {active_users}):**")
+    if rows:
+        pages = (total_users + DATA_PAGE_SIZE - 1) // DATA_PAGE_SIZE
+        lines.append(f"Page {offset // DATA_PAGE_SIZE + 1} of {pages}")
+        for uid, joined, active in rows:
+            line = f"• `{uid}`"
+            if joined:
+                line += f" · joined {datetime.fromtimestamp(joined, timezone.utc):%Y-%m-%d}"
+            if not active:
+                line += " · 🚫 inactive"
+            lines.append(line)
+    else:
+        lines.append("• No users found")
+    
+    # The offset travels in the callback data, so paging needs no state on our side
+    buttons = []
+    if offset > 0:
+        buttons.append(InlineKeyboardButton("« Prev", callback_data=f"data:{max(0, offset - DATA_PAGE_SIZE)}"))
+    if offset + DATA_PAGE_SIZE < total_users:
+        buttons.append(InlineKeyboardButton("Next »", callback_data=f"data:{offset + DATA_PAGE_SIZE}"))
+    return "\n".join(lines), InlineKeyboardMarkup([buttons]) if buttons else None
+
+
+@observe_handler
 async def view_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle /data command - view admins and user stats data (admin only)"""
+    """Handle /data command - view admins and a page of users (admin only)"""
     user_id = update.effective_user.id
     
-    if not is_admin(user_id):
+    if not await is_admin(user_id):
         await update.message.reply_text(
             "❌ Access denied. Only administrators can view data."
         )
         return
     
-    # Load admins data
-    admins_data = load_admins()
-    admins_list = admins_data.get("admins", [])
+    text, reply_markup = await render_data_page(0)
+    await update.message.reply_text(text, parse_mode='Markdown', reply_markup=reply_markup)
+
+
+@observe_handler
+async def data_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle the prev/next buttons under /data - show another page in place"""
+    query = update.callback_query
+    if not await is_admin(query.from_user.id):
+        await query.answer("❌ Access denied.", show_alert=True)
+        return
     
-    # Load user stats data
-    stats = load_user_stats()
-    user_ids = list(set(stats.get("users", [])))
+    text, reply_markup = await render_data_page(int(query.data.split(":", 1)[1]))
+    await query.answer()
+    try:
+        await query.edit_message_text(text, parse_mode='Markdown', reply_markup=reply_markup)
+    except BadRequest as e:
+        # Pressed twice, or nothing changed since the page was shown
+        if "not modified" not in str(e).lower():
+            raise
+
+
+@observe_handler
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /export command - send all users as a CSV or JSON Lines file (admin only)"""
+    user_id = update.effective_user.id
     
-    # Format admins data
-    admins_text = "👑 **Admins:**\n"
-    if admins_list:
-        for admin_id in admins_list:
-            admins_text += f"• `{admin_id}`\n"
-    else:
-        admins_text += "• No admins found\n"
-    
-    # Format users data
-    users_text = f"\n👥 **Users (Total: {len(user_ids)}):**\n"
-    if user_ids:
-        # Show first 20 users, then count
-        display_users = user_ids[:20]
-        for user_id in display_users:
-            users_text += f"• `{user_id}`\n"
-        if len(user_ids) > 20:
-            users_text += f"\n... and {len(user_ids) - 20} more users\n"
-    else:
-        users_text += "• No users found\n"
+    if not await is_admin(user_id):
+        await update.message.reply_text(
+            "❌ Access denied. Only administrators can export users."
+        )
+        return
     
-    # Combine and send
-    data_text = admins_text + users_text
+    export_format = context.args[0].lower() if context.args else "csv"
+    if export_format not in EXPORT_FORMATS:
+        await update.message.reply_text(
+            "Usage: /export [csv|jsonl]\n\n"
+            "Sends every user (ID, join time, active) as a file."
+        )
+        return
     
-    # Telegram message limit is 4096 characters
-    if len(data_text) > 4000:
-        # Send in parts if too long
-        part1 = admins_text + f"\n👥 **Users (Total: {len(user_ids)}):**\n"
-        await update.message.reply_text(part1, parse_mode='Markdown')
-        
-        if user_ids:
-            users_list = "\n".join([f"• `{uid}`" for uid in user_ids[:50]])
-            if len(user_ids) > 50:
-                users_list += f"\n... and {len(user_ids) - 50} more"
-            await update.message.reply_text(users_list, parse_mode='Markdown')
+    # Written chunk by chunk to a temporary file, so the list is never built in memory
+    with tempfile.TemporaryFile() as export_file:
+        count = await export_users(storage, export_format, export_file)
+        export_file.seek(0)
+        await update.message.reply_document(
+            document=export_file,
+            filename=f"users-{datetime.now(timezone.utc):%Y%m%d-%H%M}.{export_format}",
+            caption=f"📦 {count} users"
+        )
+    logger.info("Admin %s exported %s users as %s", user_id, count, export_format)
+
+
+def format_mailing_time(timestamp):
+    return datetime.fromtimestamp(timestamp, mailing_tz).strftime(f"%Y-%m-%d %H:%M ({MAILING_TIMEZONE})")
+
+
+async def reply_mailing_plan(message, plan):
+    """Tell the admin what a submitted (or dry-run) mailing will do"""
+    eta_minutes = max(1, round(plan.eta / 60))
+    pacing = f"spread over {eta_minutes} min" if plan.drip else f"about {eta_minutes} min at the current send rate"
+    if plan.start_at:
+        pacing += f", starting {format_mailing_time(plan.start_at)}"
+    if plan.dry_run:
+        await message.reply_text(
+            f"🧪 Dry run: this message would go to {plan.recipients} users "
+            f"({plan.segment.describe()}; {pacing}).\n"
+            f"Nothing was sent. Reply with /mailing (without \"dry\") to send it."
+        )
+        return
+    # Mailing runs in the background as a persisted job, so the handler returns immediately;
+    # this reply is then edited in place with the job's progress
+    if plan.start_at:
+        title = f"🗓 Mailing to {plan.recipients} users scheduled (job {plan.job.id})"
+    elif job_manager.running_count():
+        title = f"🕒 Mailing to {plan.recipients} users queued behind the current mailing (job {plan.job.id})"
     else:
-        await update.message.reply_text(data_text, parse_mode='Markdown')
+        title = f"📤 Mailing to {plan.recipients} users... (job {plan.job.id})"
+    status = await message.reply_text(
+        f"{title}\n"
+        f"Audience: {plan.segment.describe()}; {pacing}.\n"
+        f"This message shows the progress; you will get a report when it finishes. "
+        f"Use /jobs to pause or cancel."
+    )
+    await job_manager.track_progress(plan.job, status.chat_id, status.message_id)
 
 
+@observe_handler
 async def mailing_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /mailing command - mailing the replied message to all users"""
     user_id = update.effective_user.id
     message = update.message
     
     # Check admin permission
-    if not is_admin(user_id):
+    if not await is_admin(user_id):
         await update.message.reply_text(
             "❌ Access denied. Only administrators can mailing messages."
         )
@@ -415,141 +560,34 @@ async def mailing_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(
             "📤 **How to use /mailing:**\n\n"
             "1. Send or forward the post you want to mailing\n"
-            "2. Reply to that message with /mailing\n\n"
+            "2. Reply to that message with /mailing\n"
+            "   (or /mailing dry to see how many users would get it, without sending)\n\n"
+            "Options (any order): active | inactive | all, since=2024-05-01 or since=7d, "
+            "sample=10%, drip=2h (spread delivery over 2 hours), "
+            f"at 18:30 or at 2024-05-01 18:30 ({MAILING_TIMEZONE}), in 2h.\n"
+            "Example: /mailing since=30d sample=20% drip=1h at 20:00\n\n"
             "Or simply forward a post to this bot (it will auto-detect and mailing)."
         )
         return
     
-    # Get the replied message
-    replied_message = message.reply_to_message
-    
-    # Load all users
-    stats = load_user_stats()
-    user_ids = list(set(stats["users"]))
-    
-    # Exclude admin from mailing list (admin already sees the message)
-    user_ids = [uid for uid in user_ids if uid != user_id]
-    
-    if not user_ids:
-        await update.message.reply_text("❌ No users found to mailing to (excluding yourself).")
-        return
-    
-    # Confirm mailing start
-    await update.message.reply_text(
-        f"📤 Mailing to {len(user_ids)} users...\n"
-        f"Please wait..."
-    )
-    
-    success_count = 0
-    failed_count = 0
-    
-    # Extract message content
-    has_photo = replied_message.photo is not None and len(replied_message.photo) > 0
-    has_video = replied_message.video is not None
-    has_document = replied_message.document is not None
-    caption = replied_message.caption
-    text = replied_message.text if not (has_photo or has_video or has_document) else None
-    
-    logger.info(f"Mailing command - Photo: {has_photo}, Video: {has_video}, Document: {has_document}, Text: {text is not None}, Caption: {caption is not None}")
-    
-    # Check if we have any content to mailing
-    if not (has_photo or has_video or has_document or text):
-        await update.message.reply_text(
-            "❌ Cannot mailing: Replied message has no content (photo, video, document, or text)."
-        )
+    # "/mailing dry" shows who would get the message without sending anything
+    try:
+        options = MailingOptions.parse(context.args or [], mailing_tz)
+        plan = await mailing_pipeline.submit(message.reply_to_message, user_id, message.chat_id, options)
+    except MailingError as e:
+        await update.message.reply_text(str(e))
         return
-    
-    # Mailing to all users
-    # Priority: Use forward_message to preserve Premium emoji and all formatting
-    for target_user_id in user_ids:
-        try:
-            message_sent = False
-            
-            # First, try to forward the message (preserves Premium emoji and all formatting)
-            try:
-                await context.bot.forward_message(
-                    chat_id=target_user_id,
-                    from_chat_id=replied_message.chat_id,
-                    message_id=replied_message.message_id
-                )
-                success_count += 1
-                message_sent = True
-                logger.info(f"Forwarded message to user {target_user_id} (preserving Premium emoji)")
-            except Exception as forward_error:
-                # If forwarding fails, fall back to resending (loses Premium emoji but ensures delivery)
-                logger.warning(f"Forward failed for user {target_user_id}, trying to resend: {forward_error}")
-                
-                if has_photo:
-                    photo = replied_message.photo[-1] if replied_message.photo else None
-                    if photo and photo.file_id:
-                        await context.bot.send_photo(
-                            chat_id=target_user_id,
-                            photo=photo.file_id,
-                            caption=caption,
-                            parse_mode='HTML' if caption else None
-                        )
-                        success_count += 1
-                        message_sent = True
-                        logger.info(f"Sent photo to user {target_user_id} (fallback)")
-                elif has_video:
-                    video = replied_message.video
-                    if video and video.file_id:
-                        await context.bot.send_video(
-                            chat_id=target_user_id,
-                            video=video.file_id,
-                            caption=caption,
-                            parse_mode='HTML' if caption else None
-                        )
-                        success_count += 1
-                        message_sent = True
-                        logger.info(f"Sent video to user {target_user_id} (fallback)")
-                elif has_document:
-                    document = replied_message.document
-                    if document and document.file_id:
-                        await context.bot.send_document(
-                            chat_id=target_user_id,
-                            document=document.file_id,
-                            caption=caption,
-                            parse_mode='HTML' if caption else None
-                        )
-                        success_count += 1
-                        message_sent = True
-                        logger.info(f"Sent document to user {target_user_id} (fallback)")
-                elif text:
-                    await context.bot.send_message(
-                        chat_id=target_user_id,
-                        text=text,
-                        parse_mode='HTML'
-                    )
-                    success_count += 1
-                    message_sent = True
-                    logger.info(f"Sent text to user {target_user_id} (fallback)")
-            
-            if not message_sent:
-                failed_count += 1
-                logger.error(f"Failed to mailing to user {target_user_id}: All methods failed")
-                    
-        except Exception as e:
-            failed_count += 1
-            logger.error(f"Failed to mailing to user {target_user_id}: {e}", exc_info=True)
-    
-    # Report results
-    result_message = (
-        f"📥 Mailing completed!\n\n"
-        f"✅️ Success: {success_count}\n"
-        f"❌ Failed: {failed_count}\n"
-        f"📝 Total: {len(user_ids)}"
-    )
-    await update.message.reply_text(result_message)
+    await reply_mailing_plan(message, plan)
 
 
+@observe_handler
 async def test_mailing(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /test_mailing command - test if admin can mailing (for debugging)"""
     user_id = update.effective_user.id
     message = update.message
     
     # Check admin permission
-    is_admin_user = is_admin(user_id)
+    is_admin_user = await is_admin(user_id)
     
     # Check if message is forwarded
     is_forwarded = bool(message.forward_from or message.forward_from_chat)
@@ -579,173 +617,188 @@ async def test_mailing(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(debug_info, parse_mode='Markdown')
 
 
+@observe_handler
 async def handle_forwarded_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle forwarded messages - mailing to all users who used /start (admin only)"""
     message = update.message
     user_id = update.effective_user.id
     
     # Log for debugging
-    logger.info(f"Received message from user {user_id}, forwarded: {message.forward_from or message.forward_from_chat}")
+    logger.info(
+        "Received message from user %s, forwarded: %s",
+        user_id, message.forward_from or message.forward_from_chat
+    )
     
     # Check if message is forwarded
     if not (message.forward_from or message.forward_from_chat):
         # Not a forwarded message, ignore
-        logger.debug(f"Message from user {user_id} is not forwarded, ignoring")
+        logger.debug("Message from user %s is not forwarded, ignoring", user_id)
         return
     
     # Check admin permission
-    if not is_admin(user_id):
+    if not await is_admin(user_id):
         await update.message.reply_text(
             "❌ Access denied. Only administrators can mailing messages.\n\n"
             "💡 Tip: If you're the first user, send /setadmin to become an administrator."
         )
-        logger.warning(f"Non-admin user {user_id} attempted to mailing")
+        logger.warning("Non-admin user %s attempted to mailing", user_id)
         return
     
-    logger.info(f"Admin {user_id} is mailing a message")
-    
-    # Load all users
-    stats = load_user_stats()
-    user_ids = list(set(stats["users"]))
+    logger.info("Admin %s is mailing a message", user_id)
     
-    # Exclude admin from mailing list (admin already sees the message)
-    user_ids = [uid for uid in user_ids if uid != user_id]
+    logger.info(
+        "Message type - Photo: %s, Video: %s, Document: %s, Text: %s, Caption: %s",
+        bool(message.photo), message.video is not None, message.document is not None,
+        message.text is not None, message.caption is not None
+    )
     
-    if not user_ids:
-        await update.message.reply_text("❌ No users found to mailing to (excluding yourself).")
+    try:
+        plan = await mailing_pipeline.submit(message, user_id, message.chat_id)
+    except MailingError as e:
+        await update.message.reply_text(str(e))
         return
+    await reply_mailing_plan(message, plan)
+
+
+@observe_handler
+async def jobs_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /jobs command - list, pause, resume or cancel mailing jobs (admin only)"""
+    user_id = update.effective_user.id
     
-    # Confirm mailing start
-    await update.message.reply_text(
-        f"📤 Mailing to {len(user_ids)} users...\n"
-        f"Please wait..."
-    )
-    
-    success_count = 0
-    failed_count = 0
+    if not await is_admin(user_id):
+        await update.message.reply_text(
+            "❌ Access denied. Only administrators can manage mailing jobs."
+        )
+        return
     
-    # Extract message content - support multiple message types
-    has_photo = message.photo is not None and len(message.photo) > 0
-    has_video = message.video is not None
-    has_document = message.document is not None
-    caption = message.caption  # Caption can exist for photo, video, or document
-    text = message.text if not (has_photo or has_video or has_document) else None
+    if context.args:
+        actions = {
+            "pause": job_manager.pause,
+            "resume": job_manager.resume,
+            "cancel": job_manager.cancel,
+        }
+        if len(context.args) != 2 or context.args[0] not in actions:
+            await update.message.reply_text(
+                "Usage: /jobs [pause|resume|cancel <job_id>]\n\n"
+                "Example: /jobs pause 1a2b3c4d"
+            )
+            return
+        action, job_id = context.args
+        if await actions[action](job_id):
+            await update.message.reply_text(f"✅ Job {job_id}: {action} done.")
+            logger.info("Admin %s did %s on mailing job %s", user_id, action, job_id)
+        else:
+            await update.message.reply_text(f"❌ Job {job_id} not found or cannot {action} in its current state.")
+        return
     
-    logger.info(f"Message type - Photo: {has_photo}, Video: {has_video}, Document: {has_document}, Text: {text is not None}, Caption: {caption is not None}")
-    logger.info(f"Message details - photo list: {message.photo}, text: {text[:50] if text else None}")
+    jobs = sorted(job_manager.jobs.values(), key=lambda job: job.meta["created"], reverse=True)
+    if not jobs:
+        await update.message.reply_text("📋 No mailing jobs found.")
+        return
     
-    # Check if we have any content to mailing
-    if not (has_photo or has_video or has_document or text):
-        await update.message.reply_text(
-            "❌ Cannot mailing: Message has no content (photo, video, document, or text).\n\n"
-            "Please forward a message with content, or use /mailing command by replying to a message."
+    lines = ["📋 Mailing jobs:\n"]
+    for job in jobs[:20]:
+        counts = job.counts()
+        status = job.status
+        if "start_at" in job.meta and status in ("scheduled", "paused"):
+            status += f" for {format_mailing_time(job.meta['start_at'])}"
+        lines.append(
+            f"• {job.id} - {status} - "
+            f"✅ {counts['sent']} ❌ {counts['failed'] + counts['unknown']} "
+            f"🚫 {counts.get('unreachable', 0)} "
+            f"⏳ {counts['pending']} / {job.meta['total']}"
         )
+    await update.message.reply_text("\n".join(lines))
+
+
+async def warm_file_id_cache(bot):
+    """Hash the promo images and, if PROMO_WARMUP_CHAT_ID is set, upload the uncached ones"""
+    missing = await asyncio.to_thread(file_id_cache.warm, PROMO_IMAGES)
+    if not missing or not PROMO_WARMUP_CHAT_ID:
         return
-    
-    # Mailing to all users
-    # Priority: Use forward_message to preserve Premium emoji and all formatting
-    for target_user_id in user_ids:
+    for image_path in missing:
         try:
-            message_sent = False
-            
-            # First, try to forward the message (preserves Premium emoji and all formatting)
-            try:
-                await context.bot.forward_message(
-                    chat_id=target_user_id,
-                    from_chat_id=message.chat_id,
-                    message_id=message.message_id
-                )
-                success_count += 1
-                message_sent = True
-                logger.info(f"Forwarded message to user {target_user_id} (preserving Premium emoji)")
-            except Exception as forward_error:
-                # If forwarding fails, fall back to resending (loses Premium emoji but ensures delivery)
-                logger.warning(f"Forward failed for user {target_user_id}, trying to resend: {forward_error}")
-                
-                if has_photo:
-                    # Send photo with caption
-                    photo = message.photo[-1] if message.photo else None
-                    if photo and photo.file_id:
-                        await context.bot.send_photo(
-                            chat_id=target_user_id,
-                            photo=photo.file_id,
-                            caption=caption,
-                            parse_mode='HTML' if caption else None
-                        )
-                        success_count += 1
-                        message_sent = True
-                        logger.info(f"Sent photo to user {target_user_id} (fallback)")
-                    else:
-                        logger.warning(f"Photo file_id is None for user {target_user_id}")
-                elif has_video:
-                    # Send video with caption
-                    video = message.video
-                    if video and video.file_id:
-                        await context.bot.send_video(
-                            chat_id=target_user_id,
-                            video=video.file_id,
-                            caption=caption,
-                            parse_mode='HTML' if caption else None
-                        )
-                        success_count += 1
-                        message_sent = True
-                        logger.info(f"Sent video to user {target_user_id} (fallback)")
-                elif has_document:
-                    # Send document with caption
-                    document = message.document
-                    if document and document.file_id:
-                        await context.bot.send_document(
-                            chat_id=target_user_id,
-                            document=document.file_id,
-                            caption=caption,
-                            parse_mode='HTML' if caption else None
-                        )
-                        success_count += 1
-                        message_sent = True
-                        logger.info(f"Sent document to user {target_user_id} (fallback)")
-                elif text:
-                    # Send text message
-                    await context.bot.send_message(
-                        chat_id=target_user_id,
-                        text=text,
-                        parse_mode='HTML'
-                    )
-                    success_count += 1
-                    message_sent = True
-                    logger.info(f"Sent text to user {target_user_id} (fallback)")
-            
-            if not message_sent:
-                failed_count += 1
-                logger.error(f"Failed to mailing to user {target_user_id}: All methods failed")
-                    
+            with open(image_path, 'rb') as photo:
+                sent = await bot.send_photo(chat_id=PROMO_WARMUP_CHAT_ID, photo=photo)
+            await asyncio.to_thread(file_id_cache.put, file_id_cache.key(image_path), sent.photo[-1].file_id)
+            await bot.delete_message(chat_id=PROMO_WARMUP_CHAT_ID, message_id=sent.message_id)
+            logger.info("Uploaded %s to warm the file_id cache", image_path)
         except Exception as e:
-            failed_count += 1
-            logger.error(f"Failed to mailing to user {target_user_id}: {e}", exc_info=True)
-    
-    # Report results
-    result_message = (
-        f"📥 Mailing completed!\n\n"
-        f"✅ Success: {success_count}\n"
-        f"❌ Failed: {failed_count}\n"
-        f"📝 Total: {len(user_ids)}"
-    )
-    await update.message.reply_text(result_message)
+            logger.warning("Could not warm file_id cache for %s: %s", image_path, e)
+
+
+async def post_init(application: Application):
+    """Load stored data, warm caches and start background tasks before any update is handled"""
+    await storage.open()
+    await analytics.open()
+    await job_manager.start(application.bot)
+    await warm_file_id_cache(application.bot)
+    if METRICS_PORT:
+        await metrics_server.start(METRICS_LISTEN, METRICS_PORT)
+
+
+async def post_stop(application: Application):
+    """Stop mailing jobs and checkpoint them, while the bot's connections are still open"""
+    await job_manager.stop(timeout=shutdown_deadline.remaining(FLUSH_RESERVE))
+
+
+async def post_shutdown(application: Application):
+    """Stop background tasks and flush pending data"""
+    await metrics_server.stop()
+    await analytics.close()
+    await storage.close()
+    logger.info("Storage flushed and closed")
 
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Error handler"""
-    logger.error(f"Update {update} caused error: {context.error}")
+    logger.error("Update %s caused error: %s", update, context.error)
+
+
+def bot_api_request(pool, size, http_version="1.1"):
+    """Bot API request object with the configured timeouts, latency and pool-wait metrics"""
+    return InstrumentedRequest(
+        pool=pool,
+        connection_pool_size=size,
+        connect_timeout=BOT_API_CONNECT_TIMEOUT,
+        read_timeout=BOT_API_READ_TIMEOUT,
+        write_timeout=BOT_API_WRITE_TIMEOUT,
+        pool_timeout=BOT_API_POOL_TIMEOUT,
+        http_version=http_version
+    )
 
 
-def main():
-    """Start Bot"""
-    if not BOT_TOKEN:
-        logger.error("❗BOT_TOKEN is not set! Please set BOT_TOKEN in .env file")
-        return
-    
-    # Create application
-    application = Application.builder().token(BOT_TOKEN).build()
+def build_application():
+    """Create the application with all handlers registered"""
+    # HTTP/2 lets concurrent sends share a few connections. It needs the optional h2
+    # package, and PTB then disables HTTP/1.1, so "auto" keeps it to the official API
+    http2 = BOT_API_HTTP2 == "on" or (
+        BOT_API_HTTP2 == "auto" and not BOT_API_BASE_URL and importlib.util.find_spec("h2") is not None
+    )
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        # Handlers and mailings share one pool sized for both; long polling gets its own
+        # connection so a getUpdates waiting on Telegram never holds up a send
+        .request(bot_api_request("send", BOT_API_POOL_SIZE, "2" if http2 else "1.1"))
+        .get_updates_request(bot_api_request("get_updates", 1))
+        # Handle different chats in parallel while keeping each chat's updates in order
+        .concurrent_updates(PerChatUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+    )
+    if BOT_API_BASE_URL:
+        builder = builder.base_url(f"{BOT_API_BASE_URL.rstrip('/')}/bot")
+        builder = builder.base_file_url(f"{BOT_API_BASE_URL.rstrip('/')}/file/bot")
+    if BOT_MODE == "webhook":
+        # Updates come from our own HTTP server instead of getUpdates
+        builder = builder.updater(None)
+    application = builder.build()
     
+    # Flood control runs first (group -1) and stops dropped updates from reaching any handler
+    application.add_handler(TypeHandler(Update, flood_guard), group=-1)
+
     # Register handlers
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("stats", stat))
@@ -753,8 +806,11 @@ def main():
     application.add_handler(CommandHandler("removeadmin", removeadmin))
     application.add_handler(CommandHandler("listadmins", listadmins))
     application.add_handler(CommandHandler("data", view_data))
+    application.add_handler(CallbackQueryHandler(data_page, pattern=r"^data:\d+$"))
+    application.add_handler(CommandHandler("export", export_command))
     application.add_handler(CommandHandler("mailing", mailing_command))
     application.add_handler(CommandHandler("test_mailing", test_mailing))
+    application.add_handler(CommandHandler("jobs", jobs_command))
     
     # Handle forwarded messages (admin only) - check for forwarded messages first
     # Use a more flexible filter to catch all forwarded messages
@@ -771,10 +827,32 @@ def main():
     
     # Register error handler
     application.add_error_handler(error_handler)
+    return application
+
+
+def main():
+    """Start Bot"""
+    if not BOT_TOKEN:
+        logger.error("❗BOT_TOKEN is not set! Please set BOT_TOKEN in .env file")
+        return
+    
+    application = build_application()
     
     # Start Bot
-    logger.info("Rolex9 Promo Bot is starting...")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    logger.info("Rolex9 Promo Bot is starting (%s mode)...", BOT_MODE)
+    if BOT_MODE == "webhook":
+        asyncio.run(run_webhook(
+            application,
+            listen=WEBHOOK_LISTEN,
+            port=PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=Update.ALL_TYPES,
+            deadline=shutdown_deadline
+        ))
+    else:
+        asyncio.run(run_polling(application, allowed_updates=Update.ALL_TYPES, deadline=shutdown_deadline))
 
 
 if __name__ == "__main__":
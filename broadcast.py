@@ -0,0 +1,288 @@
+import asyncio
+import logging
+import time
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+import metrics
+from ratelimit import KeyedRateLimiter, TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Telegram allows roughly 30 messages/sec overall and 1 message/sec per chat.
+# Default tuning stays a little under the global limit (overridable from config.py)
+GLOBAL_RATE = 25.0
+PER_CHAT_INTERVAL = 1.0
+WORKERS = 8
+# Items queued ahead of the workers, per worker
+QUEUE_PER_WORKER = 4
+# Give up on a recipient after this many RetryAfter responses
+MAX_RETRIES = 5
+
+# Delivery failure classes
+BLOCKED = "blocked"
+CHAT_NOT_FOUND = "chat_not_found"
+DEACTIVATED = "deactivated"
+TRANSIENT = "transient"
+OTHER = "other"
+# Failures that will not go away by retrying: the recipient is gone for good
+PERMANENT_FAILURES = (BLOCKED, CHAT_NOT_FOUND, DEACTIVATED)
+
+# Delivery strategies, in order of preference
+FORWARD = "forward"
+COPY = "copy_message"
+RESEND = "resend"
+# Recipients to probe before giving up on finding a strategy that works
+PROBE_LIMIT = 3
+
+RETRY_AFTER = metrics.counter(
+    "bot_broadcast_retry_after_total", "RetryAfter (429) responses received while mailing"
+)
+PAUSED_SECONDS = metrics.counter(
+    "bot_broadcast_paused_seconds_total", "Seconds of RetryAfter pauses requested by Telegram"
+)
+RATE_LIMIT_WAIT = metrics.histogram(
+    "bot_broadcast_rate_limit_wait_seconds", "Time a send waited for the rate limiters"
+)
+STAGE_SECONDS = metrics.histogram(
+    "bot_mailing_stage_seconds", "Time spent in each mailing pipeline stage", ("stage",),
+    buckets=metrics.DEFAULT_BUCKETS + (30.0, 60.0, 300.0, 1800.0, 7200.0)
+)
+
+
+class Stopped(Exception):
+    """The broadcast was stopped while a request waited to be sent; nothing was sent"""
+
+
+def classify_error(error):
+    """Map a delivery exception to one of the failure classes"""
+    message = str(error).lower()
+    if isinstance(error, Forbidden):
+        # "bot was blocked by the user", "user is deactivated", "bot can't initiate conversation..."
+        return DEACTIVATED if "deactivated" in message else BLOCKED
+    if isinstance(error, BadRequest):
+        # BadRequest subclasses NetworkError, so it has to be checked first
+        return CHAT_NOT_FOUND if "chat not found" in message else OTHER
+    if isinstance(error, NetworkError):
+        # Includes TimedOut
+        return TRANSIENT
+    return OTHER
+
+
+# Queued after the last item, tells a worker to exit
+_END = object()
+
+
+class BroadcastResult:
+    """Counters for one broadcast run"""
+
+    def __init__(self, total):
+        self.total = total
+        self.success = 0
+        self.failed = 0
+        self.started = time.monotonic()
+        self.finished = None
+
+    @property
+    def duration(self):
+        return (self.finished or time.monotonic()) - self.started
+
+
+class Broadcaster:
+    """Delivers messages to many chats with a bounded worker pool and shared rate limits"""
+
+    def __init__(self, rate=GLOBAL_RATE, per_chat_interval=PER_CHAT_INTERVAL, workers=WORKERS):
+        self.workers = workers
+        self.limiter = TokenBucket(rate)
+        self.chat_limiter = KeyedRateLimiter(per_chat_interval)
+        # Monotonic time until which every worker holds off (set by RetryAfter)
+        self._paused_until = 0.0
+
+    async def _wait_pause(self, stop=None):
+        """Sit out a RetryAfter pause; raise Stopped if stop is set meanwhile"""
+        delay = self._paused_until - time.monotonic()
+        if delay <= 0:
+            return
+        if stop is None:
+            await asyncio.sleep(delay)
+            return
+        try:
+            await asyncio.wait_for(stop.wait(), delay)
+        except asyncio.TimeoutError:
+            return
+        raise Stopped()
+
+    async def _throttle(self, chat_id, stop=None):
+        started = time.monotonic()
+        await self._wait_pause(stop)
+        await self.chat_limiter.wait(chat_id)
+        await self.limiter.acquire()
+        # A RetryAfter may have come in while this worker queued for a token;
+        # sit the pause out (and take a fresh token) until none is left
+        while self._paused_until > time.monotonic():
+            await self._wait_pause(stop)
+            await self.limiter.acquire()
+        RATE_LIMIT_WAIT.observe(time.monotonic() - started)
+
+    async def call(self, chat_id, request, stop=None):
+        """Run one API request to chat_id under the rate limits
+
+        request is a zero-argument callable returning a coroutine. On
+        RetryAfter the whole pool pauses for the requested time and the
+        request is retried. If the stop event is set during a pause,
+        Stopped is raised instead of sending.
+        """
+        for attempt in range(MAX_RETRIES):
+            await self._throttle(chat_id, stop)
+            try:
+                return await request()
+            except RetryAfter as e:
+                RETRY_AFTER.inc()
+                PAUSED_SECONDS.inc(e.retry_after)
+                self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+                logger.warning(
+                    "Rate limited by Telegram, pausing broadcast for %ss", e.retry_after,
+                    extra={"retry_after": e.retry_after, "sample": "retry_after"}
+                )
+                if attempt == MAX_RETRIES - 1:
+                    raise
+
+    async def run(self, items, deliver, stop=None, total=None):
+        """Call deliver(item) for every item, return a BroadcastResult
+
+        items may be any iterable, read lazily into a short queue ahead of
+        the workers; pass total when it has no len(). deliver is awaited
+        once per item and should return True on success; exceptions count
+        as failures. If the stop event is set, workers finish their
+        current item and no new items are started.
+        """
+        result = BroadcastResult(len(items) if total is None else total)
+        workers = min(self.workers, result.total) or 1
+        queue = asyncio.Queue(workers * QUEUE_PER_WORKER)
+
+        async def produce():
+            for item in items:
+                if stop and stop.is_set():
+                    break
+                await queue.put(item)
+            # One end marker per worker
+            for _ in range(workers):
+                await queue.put(_END)
+
+        async def worker():
+            while not (stop and stop.is_set()):
+                item = await queue.get()
+                if item is _END:
+                    return
+                try:
+                    if await deliver(item):
+                        result.success += 1
+                    else:
+                        result.failed += 1
+                except Exception as e:
+                    result.failed += 1
+                    logger.error("Delivery failed for %s: %s", item, e, extra={"sample": "delivery_error"})
+
+        producer = asyncio.create_task(produce())
+        try:
+            await asyncio.gather(*(worker() for _ in range(workers)))
+        finally:
+            # Workers that stopped early leave the producer waiting on a full queue
+            producer.cancel()
+            await asyncio.gather(producer, return_exceptions=True)
+        result.finished = time.monotonic()
+        return result
+
+
+def payload_from_message(message):
+    """Describe a message as a JSON-serializable payload, so mailing jobs can be persisted"""
+    return {
+        "chat_id": message.chat_id,
+        "message_id": message.message_id,
+        "photo": message.photo[-1].file_id if message.photo else None,
+        "video": message.video.file_id if message.video else None,
+        "document": message.document.file_id if message.document else None,
+        "text": message.text,
+        "caption": message.caption,
+    }
+
+
+class Delivery:
+    """How one mailing reaches each recipient, decided once per run
+
+    The API call for every strategy is prepared from the payload up front.
+    The first recipient is reached with probe(), which tries forwarding
+    (keeps Premium emoji and all formatting), then copy_message, then
+    resending the content by file_id, and keeps the first that works for
+    the rest of the run. Every later recipient costs exactly one call.
+    """
+
+    def __init__(self, payload, strategy=None):
+        self.strategy = strategy
+        self.source = {"from_chat_id": payload["chat_id"], "message_id": payload["message_id"]}
+        self.resend = self._resend_call(payload)
+        # Recipients whose probe failed for reasons of the message, not the recipient
+        self._failed_probes = 0
+
+    @staticmethod
+    def _resend_call(payload):
+        """(Bot method name, arguments) that resend the payload's content, or None"""
+        caption = payload["caption"]
+        parse_mode = 'HTML' if caption else None
+        for kind, method in (("photo", "send_photo"), ("video", "send_video"), ("document", "send_document")):
+            if payload[kind]:
+                return method, {kind: payload[kind], "caption": caption, "parse_mode": parse_mode}
+        if payload["text"]:
+            return "send_message", {"text": payload["text"], "parse_mode": 'HTML'}
+        return None
+
+    def strategies(self):
+        return [FORWARD, COPY] + ([RESEND] if self.resend else [])
+
+    def request(self, bot, chat_id, strategy):
+        """Zero-argument callable making the API call for strategy (for Broadcaster.call)"""
+        if strategy == FORWARD:
+            return lambda: bot.forward_message(chat_id=chat_id, **self.source)
+        if strategy == COPY:
+            return lambda: bot.copy_message(chat_id=chat_id, **self.source)
+        method, kwargs = self.resend
+        return lambda: getattr(bot, method)(chat_id=chat_id, **kwargs)
+
+    async def send(self, broadcaster, bot, chat_id, stop=None):
+        """Deliver with the strategy fixed for this run"""
+        await broadcaster.call(chat_id, self.request(bot, chat_id, self.strategy), stop)
+        logger.debug("Delivered to user %s (%s)", chat_id, self.strategy)
+        return True
+
+    async def probe(self, broadcaster, bot, chat_id, stop=None):
+        """Deliver to chat_id trying each strategy in turn, and fix the first that works
+
+        Errors that are about the recipient (blocked, chat not found) or
+        passing (network, RetryAfter) are raised without trying further,
+        as they say nothing about the message; the caller probes again
+        with the next recipient.
+        """
+        last_error = None
+        for strategy in self.strategies():
+            try:
+                await broadcaster.call(chat_id, self.request(bot, chat_id, strategy), stop)
+            except (RetryAfter, Stopped):
+                raise
+            except Exception as e:
+                if classify_error(e) in PERMANENT_FAILURES + (TRANSIENT,):
+                    raise
+                logger.warning(
+                    "Mailing strategy %s failed, trying the next one: %s", strategy, e,
+                    extra={"strategy": strategy, "sample": "strategy_failed"}
+                )
+                last_error = e
+                continue
+            self.strategy = strategy
+            logger.info("Mailing strategy: %s", strategy, extra={"strategy": strategy})
+            return True
+        self._failed_probes += 1
+        if self._failed_probes >= PROBE_LIMIT:
+            # Nothing works for this message; stop paying for probes and let each recipient fail once
+            self.strategy = self.strategies()[-1]
+            logger.error("No mailing strategy works, using %s", self.strategy, extra={"strategy": self.strategy})
+        raise last_error
@@ -0,0 +1,634 @@
+import asyncio
+import json
+import logging
+import os
+import shutil
+import struct
+import threading
+import time
+import uuid
+from array import array
+from collections import Counter, deque
+
+from telegram.error import BadRequest
+
+import analytics
+import metrics
+from broadcast import PERMANENT_FAILURES, STAGE_SECONDS, Delivery, Stopped, classify_error
+from storage import atomic_write
+
+logger = logging.getLogger(__name__)
+
+# Job status values. Jobs run one at a time: a new job is QUEUED (or
+# SCHEDULED until its start time) and becomes RUNNING when it is its turn.
+QUEUED = "queued"
+SCHEDULED = "scheduled"
+RUNNING = "running"
+PAUSED = "paused"
+CANCELLED = "cancelled"
+DONE = "done"
+
+# Per-recipient delivery state. A recipient is CLAIMED before the send and
+# gets its outcome after it; a recipient left CLAIMED by a crash is never
+# retried, which is what guarantees no user gets the same mailing twice.
+PENDING = 0
+CLAIMED = 1
+SENT = 2
+FAILED = 3
+# Failed permanently (blocked the bot, deleted account, chat not found)
+UNREACHABLE = 4
+
+# Progress log record: recipient index, new state
+PROGRESS_RECORD = struct.Struct("<IB")
+# Seconds to let in-flight sends finish when stopping jobs
+STOP_TIMEOUT = 10.0
+# Unreachable users are marked inactive in the user store in batches of this size
+INACTIVE_BATCH = 100
+# Seconds between edits of a job's live progress message
+PROGRESS_INTERVAL = 10.0
+# The send rate shown in the progress message is averaged over this many seconds
+RATE_WINDOW = 60.0
+
+DELIVERIES = metrics.counter(
+    "bot_broadcast_deliveries_total", "Mailing recipients processed, by outcome", ("result",)
+)
+STATE_NAMES = {SENT: "sent", FAILED: "failed", UNREACHABLE: "unreachable"}
+PROGRESS_EDITS = metrics.counter(
+    "bot_broadcast_progress_edits_total", "Edits of mailing progress messages, by outcome", ("result",)
+)
+STATUS_TITLES = {
+    QUEUED: "🕒 Mailing queued",
+    SCHEDULED: "🗓 Mailing scheduled",
+    RUNNING: "📤 Mailing in progress...",
+    PAUSED: "⏸ Mailing paused",
+    CANCELLED: "🛑 Mailing cancelled",
+    DONE: "📥 Mailing completed!",
+}
+
+
+def format_duration(seconds):
+    """Short human-readable duration: 45s, 12m 05s, 3h 20m"""
+    seconds = int(seconds)
+    if seconds < 60:
+        return f"{seconds}s"
+    minutes, seconds = divmod(seconds, 60)
+    if minutes < 60:
+        return f"{minutes}m {seconds:02d}s"
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h {minutes:02d}m"
+
+
+def progress_text(job, rate=None):
+    """Text of a job's progress message; rate (msgs/sec) is given while it runs"""
+    counts = job.counts()
+    # Recipients in flight are still CLAIMED and count as remaining
+    remaining = counts["pending"] + (counts["unknown"] if job.status == RUNNING else 0)
+    lines = [
+        f"{STATUS_TITLES.get(job.status, job.status)} (job {job.id})",
+        "",
+        f"✅ Sent: {counts['sent']}",
+        f"❌ Failed: {counts['failed'] + (0 if job.status == RUNNING else counts['unknown'])}",
+        f"🚫 Unreachable: {counts['unreachable']}",
+        f"⏳ Remaining: {remaining} of {job.meta['total']}",
+    ]
+    if rate is not None:
+        eta = format_duration(remaining / rate) if rate > 0 else "unknown"
+        lines.append(f"⚡ {rate:.1f} msgs/sec, ETA {eta}")
+    return "\n".join(lines)
+
+
+class BroadcastJob:
+    """A persisted mailing: payload, recipient snapshot and per-recipient delivery state
+
+    Stored in its own directory under DATA_DIR/broadcasts:
+      job.json        metadata (payload, status, report chat, final counts)
+      recipients.bin  recipient IDs as int64, in delivery order
+      progress.log    append-only (index, state) records
+    """
+
+    def __init__(self, job_dir, meta, recipients, states):
+        self.job_dir = job_dir
+        self.meta = meta
+        self.recipients = recipients
+        self.states = states
+        self._log_fd = None
+        # job.json is written from worker threads (the run, progress tracking,
+        # /jobs commands); concurrent writes would share one temp file
+        self._meta_lock = threading.Lock()
+
+    @property
+    def id(self):
+        return self.meta["id"]
+
+    @property
+    def status(self):
+        return self.meta["status"]
+
+    @classmethod
+    def create(cls, jobs_dir, payload, recipients, report_chat_id, drip=None, start_at=None):
+        job_id = uuid.uuid4().hex[:8]
+        job_dir = os.path.join(jobs_dir, job_id)
+        os.makedirs(job_dir)
+        if not isinstance(recipients, array):
+            recipients = array('q', recipients)
+        atomic_write(os.path.join(job_dir, "recipients.bin"), recipients.tobytes())
+        created = int(time.time())
+        meta = {
+            "id": job_id,
+            "created": created,
+            "status": SCHEDULED if start_at and start_at > created else QUEUED,
+            "payload": payload,
+            "report_chat_id": report_chat_id,
+            "total": len(recipients),
+        }
+        if start_at:
+            meta["start_at"] = start_at
+        if drip:
+            # Turned into a wall-clock deadline when the job first starts
+            meta["drip"] = drip
+        job = cls(job_dir, meta, recipients, bytearray(len(recipients)))
+        job.save_meta()
+        return job
+
+    @classmethod
+    def load(cls, job_dir):
+        with open(os.path.join(job_dir, "job.json"), 'r') as f:
+            meta = json.load(f)
+        recipients = array('q')
+        states = bytearray()
+        if meta["status"] not in (DONE, CANCELLED):
+            with open(os.path.join(job_dir, "recipients.bin"), 'rb') as f:
+                recipients.frombytes(f.read())
+            states = bytearray(len(recipients))
+            log_path = os.path.join(job_dir, "progress.log")
+            if os.path.exists(log_path):
+                with open(log_path, 'rb') as f:
+                    data = f.read()
+                whole = len(data) - len(data) % PROGRESS_RECORD.size
+                for index, state in PROGRESS_RECORD.iter_unpack(data[:whole]):
+                    states[index] = state
+        return cls(job_dir, meta, recipients, states)
+
+    def save_meta(self):
+        with self._meta_lock:
+            atomic_write(os.path.join(self.job_dir, "job.json"), json.dumps(self.meta).encode())
+
+    def mark(self, index, state):
+        """Record a recipient's new state (one small unbuffered append)"""
+        if self._log_fd is None:
+            self._log_fd = os.open(
+                os.path.join(self.job_dir, "progress.log"),
+                os.O_WRONLY | os.O_APPEND | os.O_CREAT
+            )
+        self.states[index] = state
+        os.write(self._log_fd, PROGRESS_RECORD.pack(index, state))
+
+    def checkpoint(self):
+        """Make the progress log durable and close it"""
+        if self._log_fd is not None:
+            os.fsync(self._log_fd)
+            os.close(self._log_fd)
+            self._log_fd = None
+
+    def pending(self):
+        """Yield indices of recipients that have not been attempted yet
+
+        The states are searched as the indices are taken, so no list of
+        all of them is built.
+        """
+        states = self.states
+        i = states.find(PENDING)
+        while i >= 0:
+            yield i
+            i = states.find(PENDING, i + 1)
+
+    def counts(self):
+        if "counts" in self.meta:
+            return self.meta["counts"]
+        return {
+            "sent": self.states.count(SENT),
+            "failed": self.states.count(FAILED),
+            "unreachable": self.states.count(UNREACHABLE),
+            # Claimed but interrupted before the outcome was recorded
+            "unknown": self.states.count(CLAIMED),
+            "pending": self.states.count(PENDING),
+        }
+
+    def finish(self, status):
+        """Store final counts and drop the per-recipient files"""
+        self.checkpoint()
+        self.meta["counts"] = self.counts()
+        self.meta["status"] = status
+        self.meta["finished"] = int(time.time())
+        self.save_meta()
+        for name in ("recipients.bin", "progress.log"):
+            path = os.path.join(self.job_dir, name)
+            if os.path.exists(path):
+                os.remove(path)
+        self.recipients = array('q')
+        self.states = bytearray()
+
+
+class JobManager:
+    """Runs mailing jobs one at a time on the shared broadcaster
+
+    Waiting jobs start in order of their start time (creation time for
+    jobs that were not scheduled), so two mailings never split the rate
+    budget between them. Jobs are persisted, so scheduled jobs survive a
+    restart and unfinished ones resume where they stopped.
+    """
+
+    def __init__(self, jobs_dir, broadcaster, storage, progress_interval=PROGRESS_INTERVAL, analytics=None):
+        self.jobs_dir = jobs_dir
+        self.broadcaster = broadcaster
+        # User store, told about recipients that turned out to be unreachable
+        self.storage = storage
+        # Optional Analytics, given a delivered or failed event per recipient
+        self.analytics = analytics
+        self.progress_interval = progress_interval
+        self.bot = None
+        # Whatever makes the delivery API calls; the bot unless start() is given another
+        self.backend = None
+        self.jobs = {}
+        self._tasks = {}
+        self._stops = {}
+        self._scheduler = None
+        # Set whenever the scheduler may have a job to start
+        self._wakeup = asyncio.Event()
+
+    def _load_jobs(self):
+        os.makedirs(self.jobs_dir, exist_ok=True)
+        jobs = {}
+        for name in os.listdir(self.jobs_dir):
+            job_dir = os.path.join(self.jobs_dir, name)
+            try:
+                job = BroadcastJob.load(job_dir)
+            except (OSError, ValueError, KeyError) as e:
+                logger.error("Skipping unreadable mailing job %s: %s", job_dir, e)
+                continue
+            jobs[job.id] = job
+        return jobs
+
+    async def start(self, bot, backend=None):
+        """Load persisted jobs, resume the ones that were running and start the scheduler
+
+        Reports go to admins through bot. Deliveries go through backend,
+        any object with the Bot's forward_message, copy_message and
+        send_* coroutines (a stub in tests); it defaults to bot.
+        """
+        self.bot = bot
+        self.backend = backend or bot
+        self.jobs = await asyncio.to_thread(self._load_jobs)
+        for job in self.jobs.values():
+            if job.status == RUNNING:
+                logger.info("Resuming mailing job %s (%s recipients left)", job.id, job.counts()["pending"])
+                self._launch(job)
+        self._scheduler = asyncio.create_task(self._schedule())
+
+    async def stop(self, timeout=STOP_TIMEOUT):
+        """Stop running jobs (they stay RUNNING on disk and resume on next start)"""
+        if self._scheduler:
+            self._scheduler.cancel()
+            self._scheduler = None
+        for stop in self._stops.values():
+            stop.set()
+        tasks = list(self._tasks.values())
+        if tasks:
+            done, still_running = await asyncio.wait(tasks, timeout=timeout)
+            for task in still_running:
+                task.cancel()
+            # Let them run their cleanup (unreachable users, counters) before the checkpoint
+            await asyncio.gather(*still_running, return_exceptions=True)
+        for job in self.jobs.values():
+            job.checkpoint()
+
+    async def submit(self, payload, recipients, report_chat_id, drip=None, start_at=None):
+        """Persist a new job and queue it; it starts when no other job is running
+
+        With start_at (unix time) it waits until then at the earliest. With
+        drip (seconds), deliveries are spread evenly over that window
+        instead of going out as fast as the broadcaster allows.
+        """
+        job = await asyncio.to_thread(
+            BroadcastJob.create, self.jobs_dir, payload, recipients, report_chat_id, drip, start_at
+        )
+        self.jobs[job.id] = job
+        self.remove_finished()
+        self._wakeup.set()
+        return job
+
+    def waiting(self):
+        """Queued and scheduled jobs, in the order they will start"""
+        jobs = [job for job in self.jobs.values() if job.status in (QUEUED, SCHEDULED)]
+        return sorted(jobs, key=lambda job: (job.meta.get("start_at", job.meta["created"]), job.meta["created"]))
+
+    async def _schedule(self):
+        """Background task: start the next due job whenever none is running"""
+        while True:
+            self._wakeup.clear()
+            timeout = None
+            if not self._tasks:
+                now = time.time()
+                for job in self.waiting():
+                    start_at = job.meta.get("start_at", 0)
+                    if start_at <= now:
+                        logger.info("Starting mailing job %s (%s recipients)", job.id, job.meta["total"])
+                        job.meta["status"] = RUNNING
+                        await asyncio.to_thread(job.save_meta)
+                        self._launch(job)
+                        break
+                    # Sleep until the earliest scheduled job is due
+                    timeout = start_at - now if timeout is None else min(timeout, start_at - now)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _launch(self, job):
+        stop = asyncio.Event()
+        self._stops[job.id] = stop
+        self._tasks[job.id] = asyncio.create_task(self._run(job, stop))
+
+    async def track_progress(self, job, chat_id, message_id):
+        """Keep the given message updated with the job's progress until it ends"""
+        job.meta["progress_message"] = {"chat_id": chat_id, "message_id": message_id}
+        await asyncio.to_thread(job.save_meta)
+        if job.status in (PAUSED, CANCELLED, DONE):
+            # Stopped or finished before the message was attached
+            await self._edit_progress(job)
+
+    async def _edit_progress(self, job, rate=None):
+        """Edit the job's progress message; return False once it cannot be edited any more"""
+        target = job.meta.get("progress_message")
+        if not target:
+            return False
+        text = progress_text(job, rate)
+        try:
+            # Through the broadcaster, so edits share the send budget instead of causing 429s
+            await self.broadcaster.call(
+                target["chat_id"],
+                lambda: self.bot.edit_message_text(
+                    text, chat_id=target["chat_id"], message_id=target["message_id"]
+                )
+            )
+        except BadRequest as e:
+            if "not modified" in str(e).lower():
+                PROGRESS_EDITS.inc(result="unchanged")
+                return True
+            # Deleted by the admin, or too old to edit
+            logger.warning("Stopped progress updates of mailing job %s: %s", job.id, e)
+            PROGRESS_EDITS.inc(result="error")
+            job.meta.pop("progress_message", None)
+            return False
+        except Exception as e:
+            logger.warning(
+                "Could not update progress of mailing job %s: %s", job.id, e,
+                extra={"job_id": job.id, "sample": "progress_edit_failed"}
+            )
+            PROGRESS_EDITS.inc(result="error")
+            return True
+        PROGRESS_EDITS.inc(result="edited")
+        return True
+
+    async def _report_progress(self, job):
+        """Edit the progress message every progress_interval seconds while the job runs
+
+        Edits are debounced: nothing is sent when no recipient finished
+        since the last edit, so a paused or rate-limited job costs nothing.
+        """
+        # (monotonic time, recipients done) samples for the moving send rate
+        samples = deque([(time.monotonic(), self._done(job))])
+        last_done = samples[0][1]
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            done = self._done(job)
+            now = time.monotonic()
+            samples.append((now, done))
+            while len(samples) > 2 and now - samples[1][0] >= RATE_WINDOW:
+                samples.popleft()
+            if done == last_done:
+                continue
+            last_done = done
+            oldest_time, oldest_done = samples[0]
+            if not await self._edit_progress(job, (done - oldest_done) / (now - oldest_time)):
+                return
+
+    @staticmethod
+    def _done(job):
+        counts = job.counts()
+        return counts["sent"] + counts["failed"] + counts["unreachable"]
+
+    def _log_summary(self, job, status, attempted, errors, duration, timings):
+        """One aggregated record per run of a job, instead of a line per recipient"""
+        for stage, seconds in timings.items():
+            STAGE_SECONDS.observe(seconds, stage=stage)
+        counts = job.counts()
+        logger.info(
+            "Mailing job %s %s: %d sent, %d failed, %d unreachable in %.1fs",
+            job.id, status, counts["sent"], counts["failed"], counts["unreachable"], duration,
+            extra={
+                "event": "broadcast_summary",
+                "job_id": job.id,
+                "status": status,
+                "total": job.meta["total"],
+                "attempted": attempted,
+                "counts": counts,
+                "strategy": job.meta.get("strategy"),
+                "errors": dict(errors),
+                "duration_s": round(duration, 3),
+                "msgs_per_sec": round(attempted / duration, 1) if duration else None,
+                "timings": {stage: round(seconds, 4) for stage, seconds in timings.items()},
+            }
+        )
+
+    async def _run(self, job, stop):
+        # A resumed job keeps the strategy its first run settled on
+        delivery = Delivery(job.meta["payload"], job.meta.get("strategy"))
+        unreachable = []
+        # Failure class -> count for this run, reported in the summary record
+        errors = Counter()
+        started = time.monotonic()
+        pending = job.pending()
+        remaining = job.counts()["pending"]
+        if job.meta.get("drip") and "drip_until" not in job.meta:
+            # Wall-clock deadline, so a job resumed after a restart keeps the original window
+            job.meta["drip_until"] = int(time.time() + job.meta["drip"])
+            await asyncio.to_thread(job.save_meta)
+        # Drip mode: one delivery every `spacing` seconds, so the rest of the
+        # recipients are spread over what is left of the window
+        spacing = 0.0
+        if job.meta.get("drip_until") and remaining:
+            spacing = max(0.0, job.meta["drip_until"] - time.time()) / remaining
+        next_slot = started
+        # Recipients skipped because the job stopped while waiting for a drip slot
+        skipped = 0
+
+        async def deliver(index, probe=False):
+            nonlocal next_slot, skipped
+            if spacing:
+                now = time.monotonic()
+                delay = next_slot - now
+                next_slot = max(next_slot, now) + spacing
+                if delay > 0:
+                    try:
+                        await asyncio.wait_for(stop.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    else:
+                        # Stopped: leave the recipient pending for a later run
+                        skipped += 1
+                        return False
+            chat_id = job.recipients[index]
+            job.mark(index, CLAIMED)
+            try:
+                if probe:
+                    ok = await delivery.probe(self.broadcaster, self.backend, chat_id, stop)
+                else:
+                    ok = await delivery.send(self.broadcaster, self.backend, chat_id, stop)
+                state = SENT if ok else FAILED
+            except Stopped:
+                # Stopped during a RetryAfter pause before sending: pending for a later run
+                job.mark(index, PENDING)
+                skipped += 1
+                return False
+            except Exception as e:
+                failure = classify_error(e)
+                errors[failure] += 1
+                if failure in PERMANENT_FAILURES:
+                    logger.info(
+                        "User %s is unreachable (%s), marking inactive", chat_id, failure,
+                        extra={"chat_id": chat_id, "failure": failure, "sample": "unreachable"}
+                    )
+                    state = UNREACHABLE
+                    unreachable.append(chat_id)
+                    if len(unreachable) >= INACTIVE_BATCH:
+                        await self.storage.mark_inactive(unreachable[:])
+                        unreachable.clear()
+                else:
+                    logger.warning(
+                        "Failed to mailing to user %s (%s): %s", chat_id, failure, e,
+                        extra={"chat_id": chat_id, "failure": failure, "sample": "delivery_failed"}
+                    )
+                    state = FAILED
+            job.mark(index, state)
+            DELIVERIES.inc(result=STATE_NAMES[state])
+            if self.analytics:
+                event = analytics.DELIVERED if state == SENT else analytics.FAILED
+                self.analytics.record(event, chat_id, job.id)
+            return state == SENT
+
+        probed = 0
+        timings = {}
+        reporter = asyncio.create_task(self._report_progress(job))
+        try:
+            # Recipients are probed one at a time until a strategy is found,
+            # then the rest go through the worker pool with that strategy
+            while delivery.strategy is None and not stop.is_set():
+                index = next(pending, None)
+                if index is None:
+                    break
+                await deliver(index, probe=True)
+                probed += 1
+            if delivery.strategy and "strategy" not in job.meta:
+                job.meta["strategy"] = delivery.strategy
+                await asyncio.to_thread(job.save_meta)
+            timings["probe"] = time.monotonic() - started
+            # The rest of the pending recipients, read as the workers take them
+            result = await self.broadcaster.run(pending, deliver, stop=stop, total=remaining - probed)
+            timings["dispatch"] = time.monotonic() - started - timings["probe"]
+        finally:
+            reporter.cancel()
+            self._tasks.pop(job.id, None)
+            self._stops.pop(job.id, None)
+            self._wakeup.set()
+            if unreachable:
+                await self.storage.mark_inactive(unreachable)
+        attempted = probed + result.success + result.failed - skipped
+        duration = time.monotonic() - started
+        if stop.is_set():
+            # Paused, cancelled or shutting down; whoever stopped us decides the status
+            job.checkpoint()
+            self._log_summary(job, "stopped", attempted, errors, duration, timings)
+            if job.status == PAUSED:
+                await self._edit_progress(job)
+            return
+        aggregate_started = time.monotonic()
+        counts = job.counts()
+        await asyncio.to_thread(job.finish, DONE)
+        timings["aggregate"] = time.monotonic() - aggregate_started
+        self._log_summary(job, "finished", attempted, errors, duration, timings)
+        await self._edit_progress(job)
+        # A separate message as well: edits do not notify the admin
+        await self.bot.send_message(
+            chat_id=job.meta["report_chat_id"],
+            text=(
+                f"📥 Mailing completed! (job {job.id})\n\n"
+                f"✅ Success: {counts['sent']}\n"
+                f"❌ Failed: {counts['failed'] + counts['unknown']}\n"
+                f"🚫 Unreachable (now skipped): {counts['unreachable']}\n"
+                f"📝 Total: {job.meta['total']}"
+            )
+        )
+
+    async def _halt(self, job):
+        stop = self._stops.get(job.id)
+        task = self._tasks.get(job.id)
+        if stop:
+            stop.set()
+        if task:
+            done, _ = await asyncio.wait([task], timeout=STOP_TIMEOUT)
+            if not done:
+                # Still sending: cancel it and let it unwind, so nothing writes
+                # to the job after it is finished or paused
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                job.checkpoint()
+
+    async def pause(self, job_id):
+        job = self.jobs.get(job_id)
+        if not job or job.status not in (RUNNING, QUEUED, SCHEDULED):
+            return False
+        job.meta["status"] = PAUSED
+        await asyncio.to_thread(job.save_meta)
+        await self._halt(job)
+        return True
+
+    async def resume(self, job_id):
+        """Put a paused job back in line; it continues once it is its turn"""
+        job = self.jobs.get(job_id)
+        if not job or job.status != PAUSED:
+            return False
+        job.meta["status"] = SCHEDULED if job.meta.get("start_at", 0) > time.time() else QUEUED
+        await asyncio.to_thread(job.save_meta)
+        self._wakeup.set()
+        return True
+
+    async def cancel(self, job_id):
+        job = self.jobs.get(job_id)
+        if not job or job.status not in (RUNNING, PAUSED, QUEUED, SCHEDULED):
+            return False
+        await self._halt(job)
+        await asyncio.to_thread(job.finish, CANCELLED)
+        await self._edit_progress(job)
+        return True
+
+    def running_count(self):
+        return len(self._tasks)
+
+    def waiting_count(self):
+        return sum(job.status in (QUEUED, SCHEDULED) for job in list(self.jobs.values()))
+
+    def pending_count(self):
+        """Recipients still waiting in running jobs"""
+        return sum(self.jobs[job_id].counts()["pending"] for job_id in list(self._tasks) if job_id in self.jobs)
+
+    def remove_finished(self, keep=20):
+        """Forget all but the newest `keep` finished jobs"""
+        finished = sorted(
+            (job for job in self.jobs.values() if job.status in (DONE, CANCELLED)),
+            key=lambda job: job.meta["created"],
+            reverse=True
+        )
+        for job in finished[keep:]:
+            shutil.rmtree(job.job_dir, ignore_errors=True)
+            del self.jobs[job.id]
@@ -6,6 +6,43 @@ load_dotenv()
 # Bot Token (from environment variables)
 BOT_TOKEN = os.getenv("BOT_TOKEN", "8585417637:AAHI022IQTD28YKh43a3rb29vipcpEEGqGg")
 
+# How updates reach the bot: "polling" (default) or "webhook"
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# Webhook mode: public base URL Telegram should call (e.g. https://rolex9-bot.fly.dev).
+# Leave empty to serve updates without registering a webhook (local testing)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+# Checked against the X-Telegram-Bot-Api-Secret-Token header of every webhook call
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+PORT = int(os.getenv("PORT", "8080"))
+# Alternative Bot API server (e.g. tools/fake_bot_api.py for local testing)
+BOT_API_BASE_URL = os.getenv("BOT_API_BASE_URL", "")
+
+# Logging: "json" (one JSON object per line) or "text", and the minimum level
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+
+# Prometheus metrics endpoint (GET /metrics); disabled unless METRICS_PORT is set
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "0.0.0.0")
+
+# Bot API connections. Sends and other calls share one pool of BOT_API_POOL_SIZE
+# connections (also the cap on calls in flight); getUpdates has its own connection
+BOT_API_POOL_SIZE = int(os.getenv("BOT_API_POOL_SIZE", "256"))
+# HTTP/2 for the shared pool: "auto" (when the h2 package is installed and
+# BOT_API_BASE_URL is not set), "on" or "off"
+BOT_API_HTTP2 = os.getenv("BOT_API_HTTP2", "auto").lower()
+# Timeouts in seconds: connecting, waiting for a response, sending a request (uploads
+# always get at least 20) and waiting for a free connection
+BOT_API_CONNECT_TIMEOUT = float(os.getenv("BOT_API_CONNECT_TIMEOUT", "5"))
+BOT_API_READ_TIMEOUT = float(os.getenv("BOT_API_READ_TIMEOUT", "5"))
+BOT_API_WRITE_TIMEOUT = float(os.getenv("BOT_API_WRITE_TIMEOUT", "5"))
+BOT_API_POOL_TIMEOUT = float(os.getenv("BOT_API_POOL_TIMEOUT", "1"))
+
+# Maximum number of updates handled at the same time (updates of one chat are always sequential)
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "32"))
+
 # Channel and link configuration
 TELEGRAM_CHANNEL = os.getenv("TELEGRAM_CHANNEL", "https://t.me/rolex9au")
 FREE_SPIN_URL = os.getenv("FREE_SPIN_URL", "https://rolex9au.com/RFROLEX9BOT")
@@ -14,6 +51,38 @@ FREE_CREDIT_URL = os.getenv("FREE_CREDIT_URL", "https://rolex9au.com/RFROLEX9BOT
 # Promotional images (local file paths - hardcoded in code)
 FREE_SPIN_IMAGE_PATH = "public/free_spin.jpg"
 HOT_GAME_TIPS_IMAGE_PATH = "public/hot_game_tips.jpg"
+# Optional chat (e.g. an admin's user ID) used at startup to upload promo images
+# that have no cached file_id yet; the upload is deleted right after
+PROMO_WARMUP_CHAT_ID = os.getenv("PROMO_WARMUP_CHAT_ID")
+
+# Flood control: each user may send USER_RATE_BURST updates at once, refilled at
+# USER_RATE_LIMIT per second; an identical message or button press repeated within
+# USER_DEDUP_WINDOW seconds is dropped (0 disables). Admins are never limited.
+USER_RATE_LIMIT = float(os.getenv("USER_RATE_LIMIT", "1"))
+USER_RATE_BURST = int(os.getenv("USER_RATE_BURST", "5"))
+USER_DEDUP_WINDOW = float(os.getenv("USER_DEDUP_WINDOW", "2"))
+
+# User registry write-behind: flush new users to disk every N seconds,
+# or as soon as this many new users are waiting
+USER_FLUSH_INTERVAL = float(os.getenv("USER_FLUSH_INTERVAL", "5"))
+USER_FLUSH_BATCH = int(os.getenv("USER_FLUSH_BATCH", "100"))
+
+# Analytics events (/start, button presses, mailing deliveries) are appended to
+# DATA_DIR/events/ every N seconds, or as soon as this many are waiting
+ANALYTICS_FLUSH_INTERVAL = float(os.getenv("ANALYTICS_FLUSH_INTERVAL", "5"))
+ANALYTICS_FLUSH_BATCH = int(os.getenv("ANALYTICS_FLUSH_BATCH", "1000"))
+
+# Mailing: overall send rate (Telegram allows ~30 msg/s) and number of parallel senders
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "8"))
+# Seconds between edits of a running mailing's progress message
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", "10"))
+# Time zone for "/mailing at 18:30" (an IANA name such as Asia/Kuala_Lumpur)
+MAILING_TIMEZONE = os.getenv("MAILING_TIMEZONE", "UTC")
+
+# Seconds a stop (SIGTERM/SIGINT, e.g. a deploy) may take: handlers finish, mailings
+# checkpoint, buffered data is flushed. Keep below kill_timeout in fly.toml
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", "20"))
 
 # Bot information
 BOT_NAME = "Rolex9 Promo Bot"
@@ -0,0 +1,46 @@
+import asyncio
+import csv
+import io
+import json
+from datetime import datetime, timezone
+
+EXPORT_FORMATS = ("csv", "jsonl")
+# Users read from the store and written to the file per step
+EXPORT_CHUNK = 5000
+CSV_HEADER = ("user_id", "joined_at", "active")
+
+
+def _joined(timestamp):
+    # 0: joined before join times were recorded
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat() if timestamp else ""
+
+
+def format_rows(rows, fmt):
+    """Encode (user ID, joined timestamp, active) rows as CSV or JSON Lines bytes"""
+    if fmt == "jsonl":
+        return "".join(
+            json.dumps({"user_id": user_id, "joined_at": _joined(joined), "active": active}) + "\n"
+            for user_id, joined, active in rows
+        ).encode()
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows((user_id, _joined(joined), int(active)) for user_id, joined, active in rows)
+    return buffer.getvalue().encode()
+
+
+async def export_users(storage, fmt, file, chunk_size=EXPORT_CHUNK):
+    """Write every user to the binary file object in ID order, one chunk at a time; return the count
+
+    Only one chunk of users is in memory at a time; writes happen off
+    the event loop.
+    """
+    if fmt == "csv":
+        await asyncio.to_thread(file.write, (",".join(CSV_HEADER) + "\r\n").encode())
+    count = 0
+    after = None
+    while True:
+        rows = await storage.user_rows(after=after, limit=chunk_size)
+        if not rows:
+            return count
+        await asyncio.to_thread(file.write, format_rows(rows, fmt))
+        count += len(rows)
+        after = rows[-1][0]
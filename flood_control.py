@@ -0,0 +1,91 @@
+import logging
+import time
+from collections import OrderedDict
+
+from telegram.error import TelegramError
+from telegram.ext import ApplicationHandlerStop
+
+import metrics
+from ratelimit import KeyedTokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Defaults (overridable from config.py)
+USER_RATE = 1.0
+USER_BURST = 5
+DEDUP_WINDOW = 2.0
+MAX_USERS = 10000
+
+DROPPED = metrics.counter(
+    "bot_updates_dropped_total", "Updates dropped by flood control before reaching a handler", ("reason",)
+)
+
+
+class FloodGuard:
+    """Drops updates from users who send too fast, before any handler runs
+
+    Register it as a TypeHandler(Update, guard) in group -1: for a dropped
+    update it raises ApplicationHandlerStop, so no handler (and no reply,
+    which would cost outbound API quota) runs for it. Each user gets a
+    token bucket of `burst` updates refilled at `rate` per second. With
+    dedup_window, a message or button press identical to the same user's
+    previous accepted one within that many seconds is dropped without
+    using a token. Both tables keep at most max_users users (LRU).
+    Users for whom the async is_exempt(user_id) is true (admins) are
+    never limited. A dropped button press is still answered (with no
+    text), so the user's client stops showing it as loading.
+    """
+
+    def __init__(self, rate=USER_RATE, burst=USER_BURST, dedup_window=DEDUP_WINDOW,
+                 max_users=MAX_USERS, is_exempt=None):
+        self.buckets = KeyedTokenBucket(rate, burst, max_keys=max_users)
+        self.dedup_window = dedup_window
+        self.max_users = max_users
+        self.is_exempt = is_exempt
+        # user ID -> (fingerprint, monotonic time) of the last accepted update, least recent first
+        self._last = OrderedDict()
+
+    @staticmethod
+    def fingerprint(update):
+        """What identifies a repeated press: message text or callback data (None: never deduplicated)"""
+        if update.callback_query:
+            return update.callback_query.data
+        message = update.effective_message
+        return message.text if message else None
+
+    def check(self, user_id, fingerprint=None):
+        """Return the reason to drop an update from user_id, or None to let it through"""
+        now = time.monotonic()
+        if self.dedup_window and fingerprint is not None:
+            last = self._last.get(user_id)
+            if last and last[0] == fingerprint and now - last[1] < self.dedup_window:
+                return "duplicate"
+        if not self.buckets.try_acquire(user_id):
+            return "rate_limited"
+        if self.dedup_window:
+            self._last.pop(user_id, None)
+            self._last[user_id] = (fingerprint, now)
+            if len(self._last) > self.max_users:
+                self._last.popitem(last=False)
+        return None
+
+    async def __call__(self, update, context):
+        user = update.effective_user
+        if user is None:
+            return
+        if self.is_exempt and await self.is_exempt(user.id):
+            return
+        reason = self.check(user.id, self.fingerprint(update))
+        if reason is None:
+            return
+        DROPPED.inc(reason=reason)
+        logger.info(
+            "Dropped update from user %s (%s)", user.id, reason,
+            extra={"user_id": user.id, "reason": reason, "sample": "flood_drop"}
+        )
+        if update.callback_query:
+            try:
+                await update.callback_query.answer()
+            except TelegramError as e:
+                logger.debug("Could not answer dropped callback query: %s", e)
+        raise ApplicationHandlerStop
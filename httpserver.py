@@ -0,0 +1,146 @@
+import asyncio
+import json
+import logging
+from http import HTTPStatus
+from urllib.parse import parse_qs, urlsplit
+
+logger = logging.getLogger(__name__)
+
+# Reject request bodies larger than this (Telegram updates are far smaller)
+MAX_BODY_SIZE = 1024 * 1024
+# Close idle keep-alive connections after this many seconds
+IDLE_TIMEOUT = 75.0
+
+
+class Request:
+    """A parsed HTTP request"""
+
+    def __init__(self, method, target, headers, body):
+        self.method = method
+        split = urlsplit(target)
+        self.path = split.path
+        self.query = {k: v[-1] for k, v in parse_qs(split.query).items()}
+        # Header names are lower-cased
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body or b"null")
+
+
+class Response:
+    """An HTTP response"""
+
+    def __init__(self, status=200, body=b"", content_type="text/plain; charset=utf-8", headers=None):
+        self.status = status
+        self.body = body.encode() if isinstance(body, str) else body
+        self.content_type = content_type
+        self.headers = headers or {}
+
+    @classmethod
+    def json(cls, data, status=200):
+        return cls(status, json.dumps(data), content_type="application/json")
+
+
+class HTTPServer:
+    """Minimal asyncio HTTP/1.1 server with keep-alive, for a handful of internal routes
+
+    Routes map (method, path) to an async handler taking a Request and
+    returning a Response; unmatched requests go to the fallback handler if
+    set. Each connection is served by its own task, so requests on
+    different connections are handled concurrently. stop() also closes
+    idle keep-alive connections; a request that still arrives on one is
+    answered 503 with Connection: close, so the client retries it later.
+    """
+
+    def __init__(self, fallback=None):
+        self.routes = {}
+        self.fallback = fallback
+        self._server = None
+        self._stopping = False
+        # Writers of connections waiting for their next request
+        self._idle = set()
+
+    def route(self, method, path, handler):
+        self.routes[(method, path)] = handler
+
+    async def start(self, host, port):
+        self._stopping = False
+        self._server = await asyncio.start_server(self._serve, host, port)
+        logger.info("HTTP server listening on %s:%s", host, port)
+
+    async def stop(self):
+        """Stop accepting connections and requests; requests being handled still get their response"""
+        self._stopping = True
+        for writer in list(self._idle):
+            writer.close()
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _read_request(self, reader):
+        request_line = await asyncio.wait_for(reader.readline(), IDLE_TIMEOUT)
+        if not request_line:
+            return None
+        method, target, version = request_line.decode("latin-1").split()
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length", 0))
+        if length > MAX_BODY_SIZE:
+            raise ValueError("request body too large")
+        body = await reader.readexactly(length) if length else b""
+        return Request(method, target, headers, body)
+
+    async def _serve(self, reader, writer):
+        try:
+            while True:
+                if self._stopping:
+                    return
+                self._idle.add(writer)
+                try:
+                    request = await self._read_request(reader)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                    return
+                except ValueError:
+                    await self._write(writer, Response(400, "bad request"), keep_alive=False)
+                    return
+                finally:
+                    self._idle.discard(writer)
+                if request is None:
+                    return
+                if self._stopping:
+                    await self._write(writer, Response(503, "shutting down"), keep_alive=False)
+                    return
+                handler = self.routes.get((request.method, request.path), self.fallback)
+                if handler is None:
+                    response = Response(404, "not found")
+                else:
+                    try:
+                        response = await handler(request)
+                    except Exception as e:
+                        logger.error("Error handling %s %s: %s", request.method, request.path, e, exc_info=True)
+                        response = Response(500, "internal error")
+                keep_alive = request.headers.get("connection", "").lower() != "close" and not self._stopping
+                await self._write(writer, response, keep_alive)
+                if not keep_alive:
+                    return
+        finally:
+            writer.close()
+
+    async def _write(self, writer, response, keep_alive):
+        reason = HTTPStatus(response.status).phrase
+        head = [
+            f"HTTP/1.1 {response.status} {reason}",
+            f"Content-Type: {response.content_type}",
+            f"Content-Length: {len(response.body)}",
+            f"Connection: {'keep-alive' if keep_alive else 'close'}",
+        ]
+        head += [f"{name}: {value}" for name, value in response.headers.items()]
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + response.body)
+        await writer.drain()
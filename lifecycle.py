@@ -0,0 +1,88 @@
+import asyncio
+import logging
+import signal
+import time
+
+logger = logging.getLogger(__name__)
+
+# Default seconds from the stop signal until the process exits (see config.SHUTDOWN_TIMEOUT)
+SHUTDOWN_TIMEOUT = 20.0
+# Share of the shutdown time handlers get to finish; the rest goes to mailings and flushing
+DRAIN_SHARE = 0.5
+
+
+class ShutdownDeadline:
+    """Time left for the shutdown steps, counted from the stop signal"""
+
+    def __init__(self, timeout=SHUTDOWN_TIMEOUT):
+        self.timeout = timeout
+        self._end = None
+
+    def start(self):
+        self._end = time.monotonic() + self.timeout
+
+    def remaining(self, reserve=0.0):
+        """Seconds left, minus reserve (kept for later steps); the full timeout before start()"""
+        end = self._end if self._end is not None else time.monotonic() + self.timeout
+        return max(0.0, end - time.monotonic() - reserve)
+
+
+async def run_application(application, start_updates, stop_updates, deadline=None):
+    """Run application until SIGINT/SIGTERM, then shut it down before the deadline
+
+    Startup: initialize, post_init (loads stored data and warms caches),
+    start, and only then start_updates(), so no update is handled before
+    the caches are warm. Shutdown, from the stop signal on:
+    stop_updates() (nothing new comes in), drain the handlers still
+    running (cut off after DRAIN_SHARE of the deadline), stop,
+    post_stop (mailing jobs checkpoint while the bot's connections are
+    still open), shutdown (closes the HTTP connection pools) and
+    post_shutdown (flushes buffered writes).
+    """
+    deadline = deadline or ShutdownDeadline()
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        await start_updates()
+        await stop_event.wait()
+        logger.info("Received stop signal, shutting down (deadline %gs)", deadline.timeout)
+    finally:
+        deadline.start()
+        try:
+            await stop_updates()
+        except Exception as e:
+            logger.warning("Could not stop receiving updates cleanly: %s", e)
+        drain = getattr(application.update_processor, "drain", None)
+        if drain and application.running:
+            unfinished = await drain(deadline.timeout * DRAIN_SHARE)
+            if unfinished:
+                logger.warning("Shutdown deadline: cut off %s updates still being handled", unfinished)
+        if application.running:
+            await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+        logger.info("Shutdown complete (%.1fs)", deadline.timeout - deadline.remaining())
+
+
+async def run_polling(application, allowed_updates=None, deadline=None):
+    """Run the application fetching updates with getUpdates (see run_application)"""
+    updater = application.updater
+
+    async def start_polling():
+        await updater.start_polling(allowed_updates=allowed_updates)
+
+    async def stop_polling():
+        if updater.running:
+            await updater.stop()
+
+    await run_application(application, start_polling, stop_polling, deadline)
@@ -0,0 +1,102 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+# Sampled events: at most SAMPLE_BURST records of each kind per SAMPLE_INTERVAL seconds
+SAMPLE_BURST = 10
+SAMPLE_INTERVAL = 10.0
+# Loggers that log every HTTP request at INFO (one line per Bot API call)
+NOISY_LOGGERS = ("httpx", "httpcore")
+
+# Attributes every LogRecord has; anything else was passed with extra=
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName"}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message, extra fields, traceback"""
+
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Rate-limits records logged with extra={"sample": <kind>}
+
+    The first `burst` records of a kind in each `interval` pass; the rest
+    are dropped and counted, and the next record that passes carries the
+    count as `suppressed`. Records without a sample kind always pass.
+    """
+
+    def __init__(self, burst=SAMPLE_BURST, interval=SAMPLE_INTERVAL):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        # kind -> [window start, records passed in window, records dropped since last pass]
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        kind = getattr(record, "sample", None)
+        if kind is None:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(kind)
+            if window is None or now - window[0] >= self.interval:
+                dropped = window[2] if window else 0
+                window = self._windows[kind] = [now, 0, dropped]
+            if window[1] >= self.burst:
+                window[2] += 1
+                return False
+            window[1] += 1
+            if window[2]:
+                record.suppressed = window[2]
+                window[2] = 0
+        return True
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Queues records as they are, so formatting happens on the listener thread, not the event loop"""
+
+    def prepare(self, record):
+        return record
+
+
+def setup_logging(level="INFO", log_format="json"):
+    """Route all logging through a queue to a background thread writing to stdout"""
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonFormatter() if log_format == "json" else logging.Formatter(TEXT_FORMAT))
+    log_queue = queue.SimpleQueue()
+    handler = DeferredQueueHandler(log_queue)
+    handler.addFilter(SamplingFilter())
+
+    root = logging.getLogger()
+    for existing in root.handlers[:]:
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+    for name in NOISY_LOGGERS:
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    listener.start()
+    # Drain the queue on exit so the last records are not lost
+    atexit.register(listener.stop)
+    return listener
@@ -0,0 +1,255 @@
+import logging
+import random
+import re
+import struct
+import time
+import zlib
+from array import array
+from datetime import datetime, timedelta, timezone
+
+from broadcast import STAGE_SECONDS, payload_from_message
+
+logger = logging.getLogger(__name__)
+
+# User IDs fetched from the store per query while building an audience
+AUDIENCE_CHUNK = 1000
+# "30m", "2h", "1d"...
+DURATION_PATTERN = re.compile(r"^(\d+(?:\.\d+)?)([smhd])$")
+DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+DRY_RUN_WORDS = ("dry", "dry-run", "dryrun")
+
+
+class MailingError(Exception):
+    """A mailing cannot be started; the message is meant for the admin"""
+
+
+def parse_duration(text):
+    """Seconds in a duration like 90s, 30m, 2h or 1d; MailingError if malformed"""
+    match = DURATION_PATTERN.match(text.lower())
+    if not match:
+        raise MailingError(f"❌ Invalid duration: {text} (use e.g. 90s, 30m, 2h or 1d)")
+    return float(match.group(1)) * DURATION_UNITS[match.group(2)]
+
+
+def parse_start(words, tz=timezone.utc, now=None):
+    """Unix time for "at 18:30", "at 2024-05-01 18:30" or "in 2h"; return (time, words used)
+
+    A time of day alone means its next occurrence in tz.
+    """
+    now = now or time.time()
+    if len(words) < 2:
+        raise MailingError(f"❌ Missing time after \"{words[0]}\" (e.g. at 18:30, at 2024-05-01 18:30, in 2h)")
+    if words[0] == "in":
+        return now + parse_duration(words[1]), 2
+    current = datetime.fromtimestamp(now, tz)
+    try:
+        if len(words) > 2 and re.match(r"^\d{1,2}:\d{2}$", words[2]):
+            start = datetime.strptime(f"{words[1]} {words[2]}", "%Y-%m-%d %H:%M").replace(tzinfo=tz)
+            used = 3
+        else:
+            clock = datetime.strptime(words[1], "%H:%M")
+            start = current.replace(hour=clock.hour, minute=clock.minute, second=0, microsecond=0)
+            if start <= current:
+                start += timedelta(days=1)
+            used = 2
+    except ValueError:
+        raise MailingError(f"❌ Invalid time: {' '.join(words[1:3])} (use HH:MM or YYYY-MM-DD HH:MM)")
+    if start.timestamp() <= now:
+        raise MailingError(f"❌ {start:%Y-%m-%d %H:%M} is in the past.")
+    return start.timestamp(), used
+
+
+def parse_since(text, now=None):
+    """Unix time for since=: a UTC date (2024-05-01) or a duration ago (7d)"""
+    try:
+        day = datetime.strptime(text, "%Y-%m-%d")
+    except ValueError:
+        return int((now or time.time()) - parse_duration(text))
+    return int(day.replace(tzinfo=timezone.utc).timestamp())
+
+
+class Segment:
+    """Which users a mailing goes to
+
+    active: True for reachable users, False for users marked unreachable,
+    None for everyone. joined_since: unix time, or None. sample: percent of
+    the matching users to keep, or None. The sample is decided per user
+    from a hash of the ID and a per-mailing seed, so it can be applied
+    while streaming users in chunks and needs no second pass.
+    """
+
+    def __init__(self, active=True, joined_since=None, sample=None, seed=None):
+        self.active = active
+        self.joined_since = joined_since
+        self.sample = sample
+        self.seed = seed if seed is not None else random.getrandbits(32)
+
+    def sampled(self, user_id):
+        if self.sample is None:
+            return True
+        return zlib.crc32(struct.pack("<qI", user_id, self.seed)) % 10000 < self.sample * 100
+
+    def describe(self):
+        parts = [{True: "active users", False: "inactive users", None: "all users"}[self.active]]
+        if self.joined_since is not None:
+            joined = datetime.fromtimestamp(self.joined_since, timezone.utc).strftime("%Y-%m-%d %H:%M UTC")
+            parts.append(f"joined since {joined}")
+        if self.sample is not None:
+            parts.append(f"{self.sample:g}% sample")
+        return ", ".join(parts)
+
+
+class MailingOptions:
+    """Arguments of /mailing: dry run, audience segment, drip window, start time"""
+
+    def __init__(self, dry_run=False, segment=None, drip=None, start_at=None):
+        self.dry_run = dry_run
+        self.segment = segment or Segment()
+        # Seconds to spread delivery over, or None to send as fast as allowed
+        self.drip = drip
+        # Unix time to start at, or None to start as soon as possible
+        self.start_at = start_at
+
+    @classmethod
+    def parse(cls, args, tz=timezone.utc):
+        """Parse e.g. ["dry", "inactive", "since=2024-05-01", "sample=10%", "drip=2h", "at", "18:30"]
+
+        Times of day in "at" are in tz.
+        """
+        options = cls()
+        segment = options.segment
+        words = [arg.lower() for arg in args]
+        i = 0
+        while i < len(words):
+            word = words[i]
+            i += 1
+            key, _, value = word.partition("=")
+            if word in ("at", "in"):
+                options.start_at, used = parse_start(words[i - 1:], tz)
+                i += used - 1
+            elif word in DRY_RUN_WORDS:
+                options.dry_run = True
+            elif word in ("active", "inactive", "all"):
+                segment.active = {"active": True, "inactive": False, "all": None}[word]
+            elif key == "since" and value:
+                segment.joined_since = parse_since(value)
+            elif key == "sample" and value:
+                try:
+                    segment.sample = float(value.rstrip("%"))
+                except ValueError:
+                    segment.sample = None
+                if segment.sample is None or not 0 < segment.sample <= 100:
+                    raise MailingError(f"❌ Invalid sample: {value} (use a percentage, e.g. sample=10%)")
+            elif key == "drip" and value:
+                options.drip = parse_duration(value)
+            else:
+                raise MailingError(
+                    f"❌ Unknown option: {word}\n"
+                    f"Options: dry, active|inactive|all, since=<date or 7d>, sample=<percent>, drip=<duration>, "
+                    f"at <[date] time> or in <duration>"
+                )
+        return options
+
+
+class MailingPlan:
+    """What a submitted (or dry-run) mailing will do, with per-stage timings"""
+
+    def __init__(self, recipients, payload, job=None, eta=None, segment=None, drip=None, start_at=None):
+        self.recipients = recipients
+        self.payload = payload
+        self.job = job
+        # Estimated seconds to reach everyone at the configured send rate
+        self.eta = eta
+        self.segment = segment
+        self.drip = drip
+        self.start_at = start_at
+        self.timings = {}
+
+    @property
+    def dry_run(self):
+        return self.job is None
+
+
+class MailingPipeline:
+    """The one path every mailing takes, whichever command started it
+
+    Stages: audience (the segment's users minus the sender, streamed from
+    the store in chunks) -> payload (what to send, captured from the
+    message) -> dispatch (a persisted job on the shared rate-limited
+    broadcaster) -> aggregation (per-recipient states rolled up into the
+    job's report and summary log). The first two run here when the
+    mailing is submitted; dispatch and aggregation run in JobManager,
+    which also times them. With dry_run the mailing stops after the
+    payload stage and nothing is sent.
+    """
+
+    def __init__(self, storage, job_manager, rate):
+        self.storage = storage
+        self.job_manager = job_manager
+        self.rate = rate
+
+    async def audience(self, segment, exclude=(), chunk_size=AUDIENCE_CHUNK):
+        """Yield lists of the segment's user IDs in ascending order, minus `exclude`"""
+        exclude = set(exclude)
+        after = None
+        while True:
+            chunk = await self.storage.scan_users(
+                after, chunk_size, active=segment.active, joined_since=segment.joined_since
+            )
+            if not chunk:
+                return
+            after = chunk[-1]
+            yield [user_id for user_id in chunk if user_id not in exclude and segment.sampled(user_id)]
+
+    @staticmethod
+    def payload(message):
+        if not (message.photo or message.video or message.document or message.text):
+            return None
+        return payload_from_message(message)
+
+    async def submit(self, message, sender_id, report_chat_id, options=None):
+        """Run the submit-time stages for message and start the job; return a MailingPlan
+
+        Raises MailingError when there is nobody to send to or nothing to send.
+        """
+        options = options or MailingOptions()
+        timings = {}
+        started = time.perf_counter()
+        # int64 IDs, 8 bytes each; the job snapshot is written from this as is
+        recipients = array('q')
+        # The sender already has the message
+        async for chunk in self.audience(options.segment, exclude=(sender_id,)):
+            recipients.extend(chunk)
+        timings["audience"] = time.perf_counter() - started
+        if not recipients:
+            raise MailingError(f"❌ No users found to mailing to ({options.segment.describe()}, excluding yourself).")
+
+        started = time.perf_counter()
+        payload = self.payload(message)
+        timings["payload"] = time.perf_counter() - started
+        if payload is None:
+            raise MailingError("❌ Cannot mailing: Message has no content (photo, video, document, or text).")
+
+        job = None
+        if not options.dry_run:
+            started = time.perf_counter()
+            job = await self.job_manager.submit(
+                payload, recipients, report_chat_id, drip=options.drip, start_at=options.start_at
+            )
+            timings["submit"] = time.perf_counter() - started
+
+        eta = max(len(recipients) / self.rate, options.drip or 0)
+        plan = MailingPlan(
+            len(recipients), payload, job, eta=eta, segment=options.segment, drip=options.drip,
+            start_at=options.start_at
+        )
+        plan.timings = timings
+        for stage, seconds in timings.items():
+            STAGE_SECONDS.observe(seconds, stage=stage)
+        logger.info(
+            "Mailing %s for %d recipients", "dry run" if options.dry_run else f"job {job.id}", len(recipients),
+            extra={"event": "mailing_submitted", "dry_run": options.dry_run, "recipients": len(recipients),
+                   "segment": options.segment.describe(), "drip_s": options.drip, "start_at": options.start_at,
+                   "timings": {stage: round(seconds, 4) for stage, seconds in timings.items()}}
+        )
+        return plan
@@ -0,0 +1,94 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from storage import atomic_write
+
+logger = logging.getLogger(__name__)
+
+# How often a cached image is re-checked on disk (stat) for changes
+CHECK_INTERVAL = 5.0
+
+
+class FileIdCache:
+    """Remembers Telegram file_ids of uploaded local files, keyed by path + content hash
+
+    A file is uploaded once; later sends reuse its file_id. When the file
+    changes on disk its hash changes, so the old file_id is no longer used.
+    """
+
+    def __init__(self, cache_path, check_interval=CHECK_INTERVAL):
+        self.cache_path = cache_path
+        self.check_interval = check_interval
+        # "path:sha256" -> file_id
+        self._file_ids = {}
+        # path -> (checked_at, mtime_ns, size, key)
+        self._keys = {}
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Load persisted file_ids"""
+        if os.path.exists(self.cache_path):
+            try:
+                with open(self.cache_path, 'r') as f:
+                    data = json.load(f)
+                if isinstance(data, dict):
+                    self._file_ids = data
+            except (json.JSONDecodeError, IOError) as e:
+                logger.error("Could not read %s: %s", self.cache_path, e)
+
+    def _save(self):
+        # Written under the lock too, so an older copy never replaces a newer one
+        with self._lock:
+            atomic_write(self.cache_path, json.dumps(self._file_ids).encode())
+
+    def key(self, path):
+        """Return the cache key for path's current content, or None if it does not exist"""
+        now = time.monotonic()
+        cached = self._keys.get(path)
+        if cached and now - cached[0] < self.check_interval:
+            return cached[3]
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            self._keys.pop(path, None)
+            return None
+        if cached and (cached[1], cached[2]) == (st.st_mtime_ns, st.st_size):
+            key = cached[3]
+        else:
+            with open(path, 'rb') as f:
+                key = f"{path}:{hashlib.sha256(f.read()).hexdigest()}"
+        self._keys[path] = (now, st.st_mtime_ns, st.st_size, key)
+        return key
+
+    def get(self, key):
+        return self._file_ids.get(key)
+
+    def put(self, key, file_id):
+        """Remember file_id for key and persist the cache"""
+        path = key.rsplit(":", 1)[0]
+        with self._lock:
+            # Drop file_ids of older versions of the same file
+            for old_key in [k for k in self._file_ids if k.rsplit(":", 1)[0] == path]:
+                del self._file_ids[old_key]
+            self._file_ids[key] = file_id
+        self._save()
+
+    def forget(self, key):
+        """Drop a file_id Telegram no longer accepts"""
+        with self._lock:
+            self._file_ids.pop(key, None)
+        self._save()
+
+    def warm(self, paths):
+        """Load the cache and hash the given files (run at startup, off the event loop)"""
+        self.load()
+        missing = []
+        for path in paths:
+            key = self.key(path)
+            if key and key not in self._file_ids:
+                missing.append(path)
+        return missing
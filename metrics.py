@@ -0,0 +1,274 @@
+import asyncio
+import functools
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+from telegram.error import TimedOut
+from telegram.request import BaseRequest, HTTPXRequest
+
+from httpserver import Response
+
+logger = logging.getLogger(__name__)
+
+# Latency buckets in seconds, from a fast in-memory handler to a slow Bot API call
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class Metric:
+    """A named metric with optional labels, safe to update from worker threads"""
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        """(suffix, label values, extra labels, value) for every series"""
+        with self._lock:
+            return [("", key, (), value) for key, value in self._values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for suffix, key, extra, value in self.samples():
+            lines.append(
+                f"{self.name}{suffix}{_format_labels(self.labelnames, key, extra)} {_format_value(value)}"
+            )
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._function = None
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function):
+        """Compute the (unlabelled) value at scrape time"""
+        self._function = function
+
+    def samples(self):
+        if self._function is None:
+            return super().samples()
+        try:
+            return [("", (), (), self._function())]
+        except Exception as e:
+            logger.warning("Could not compute metric %s: %s", self.name, e)
+            return []
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                # Per-bucket (not cumulative) counts, then sum
+                series = self._values[key] = [[0] * len(self.buckets), 0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total) in self._values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    samples.append(("_bucket", key, (("le", _format_value(bound)),), cumulative))
+                samples.append(("_sum", key, (), total))
+                samples.append(("_count", key, (), cumulative))
+        return samples
+
+
+class Registry:
+    """All metrics of the process, rendered in the Prometheus text format"""
+
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        return "\n".join(metric.render() for metric in self._metrics.values()) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation, labelnames=()):
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name, documentation, labelnames=()):
+    return REGISTRY.register(Gauge(name, documentation, labelnames))
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, documentation, labelnames, buckets))
+
+
+HANDLER_SECONDS = histogram(
+    "bot_handler_seconds", "Time spent in update handlers", ("handler",)
+)
+HANDLER_ERRORS = counter(
+    "bot_handler_errors_total", "Update handlers that raised an exception", ("handler",)
+)
+API_SECONDS = histogram(
+    "bot_api_request_seconds", "Bot API request latency", ("method",),
+    buckets=DEFAULT_BUCKETS + (30.0, 60.0)
+)
+API_RESPONSES = counter(
+    "bot_api_responses_total",
+    "Bot API responses by HTTP status (\"error\" for network failures, \"pool_timeout\" if never sent)",
+    ("method", "status")
+)
+API_POOL_WAIT_SECONDS = histogram(
+    "bot_api_pool_wait_seconds", "Time Bot API calls waited for a free connection, by pool", ("pool",),
+    buckets=(0.0001, 0.0005) + DEFAULT_BUCKETS
+)
+API_IN_FLIGHT = gauge("bot_api_requests_in_flight", "Bot API calls holding a connection, by pool", ("pool",))
+API_POOL_SIZE = gauge("bot_api_pool_size", "Connections each Bot API connection pool may open", ("pool",))
+STORAGE_SECONDS = histogram(
+    "bot_storage_seconds", "Time spent in storage reads and writes", ("backend", "operation")
+)
+
+
+def observe_handler(handler):
+    """Decorator recording latency and errors of an update handler under its function name"""
+    name = handler.__name__
+
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await handler(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, handler=name)
+
+    return wrapper
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest that records latency and status of every Bot API call, and pool waits
+
+    Calls take a slot of a semaphore as large as the connection pool
+    before reaching httpx, so any queueing for a connection happens (and
+    is timed) here, under the pool's name. Waiting longer than the pool
+    timeout fails the way an exhausted httpx pool does.
+    """
+
+    def __init__(self, pool="default", connection_pool_size=1, **kwargs):
+        super().__init__(connection_pool_size=connection_pool_size, **kwargs)
+        self.pool = pool
+        self._slots = asyncio.Semaphore(connection_pool_size)
+        API_POOL_SIZE.set(connection_pool_size, pool=pool)
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        pool_timeout = kwargs.get("pool_timeout", BaseRequest.DEFAULT_NONE)
+        if isinstance(pool_timeout, type(BaseRequest.DEFAULT_NONE)):
+            pool_timeout = self._client.timeout.pool
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(self._slots.acquire(), pool_timeout)
+        except asyncio.TimeoutError:
+            API_POOL_WAIT_SECONDS.observe(time.perf_counter() - started, pool=self.pool)
+            API_RESPONSES.inc(method=api_method, status="pool_timeout")
+            raise TimedOut(f"Pool timeout: all {self.pool} pool connections are busy; request was not sent")
+        API_POOL_WAIT_SECONDS.observe(time.perf_counter() - started, pool=self.pool)
+        API_IN_FLIGHT.inc(pool=self.pool)
+        started = time.perf_counter()
+        status = "error"
+        try:
+            code, payload = await super().do_request(url, method, request_data, *args, **kwargs)
+            status = code
+            return code, payload
+        finally:
+            self._slots.release()
+            API_IN_FLIGHT.dec(pool=self.pool)
+            API_SECONDS.observe(time.perf_counter() - started, method=api_method)
+            API_RESPONSES.inc(method=api_method, status=status)
+
+
+async def handle_metrics(request):
+    """HTTPServer handler for GET /metrics"""
+    return Response(200, REGISTRY.render(), content_type=CONTENT_TYPE)
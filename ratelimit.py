@@ -0,0 +1,92 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+
+class TokenBucket:
+    """Token bucket rate limiter for asyncio code (rate tokens/sec, up to capacity)"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        # Waiters queue up on the lock, so tokens are handed out first come first served
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens=1):
+        """Take tokens if available right now, return False otherwise"""
+        self._refill()
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return True
+        return False
+
+    async def acquire(self, tokens=1):
+        """Wait until tokens are available and take them"""
+        async with self._lock:
+            while not self.try_acquire(tokens):
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+
+
+class KeyedRateLimiter:
+    """Minimum interval between events per key, remembering at most max_keys keys"""
+
+    def __init__(self, interval, max_keys=10000):
+        self.interval = interval
+        self.max_keys = max_keys
+        # key -> monotonic time of the last event, oldest first
+        self._last = OrderedDict()
+
+    async def wait(self, key):
+        """Wait until key may send again, then record the event"""
+        now = time.monotonic()
+        last = self._last.pop(key, None)
+        ready_at = now if last is None else max(now, last + self.interval)
+        # Record the reserved slot before sleeping so concurrent callers queue behind it
+        self._last[key] = ready_at
+        if len(self._last) > self.max_keys:
+            self._last.popitem(last=False)
+        if ready_at > now:
+            await asyncio.sleep(ready_at - now)
+
+
+class KeyedTokenBucket:
+    """Token bucket per key (rate tokens/sec, up to capacity), remembering at most max_keys keys
+
+    A key seen for the first time (or evicted as least recently used)
+    starts with a full bucket, so the memory bound only ever errs on the
+    side of letting events through.
+    """
+
+    def __init__(self, rate, capacity, max_keys=10000):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_keys = max_keys
+        # key -> [tokens, monotonic time of last refill], least recently used first
+        self._buckets = OrderedDict()
+
+    def try_acquire(self, key, tokens=1):
+        """Take tokens from key's bucket if available right now, return False otherwise"""
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [self.capacity, now]
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(self.capacity, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] >= tokens:
+            bucket[0] -= tokens
+            return True
+        return False
+
+    def __len__(self):
+        return len(self._buckets)
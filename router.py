@@ -0,0 +1,55 @@
+import re
+
+
+class MessageRouter:
+    """Routes menu texts to handlers: exact button labels first, then patterns
+
+    Handlers are registered with the button() decorator. Each message is
+    normalized once (whitespace collapsed, upper-cased). Button labels
+    are found with one dict lookup, so the cost per message does not grow
+    with the number of buttons. Texts that are not an exact label (typed
+    by hand, edited, from an old keyboard) are matched against all
+    registered patterns at once, compiled into a single regex.
+    """
+
+    def __init__(self):
+        # Normalized label -> handler
+        self._exact = {}
+        # Pattern index -> handler; the combined regex names its groups p<index>
+        self._pattern_handlers = []
+        self._pattern_sources = []
+        self._combined = None
+        # Labels in registration order, for building the reply keyboard
+        self.buttons = []
+        # Handler -> its button label, for reporting which button was pressed
+        self.labels = {}
+
+    @staticmethod
+    def normalize(text):
+        return " ".join(text.split()).upper()
+
+    def button(self, label, *patterns):
+        """Decorator routing the keyboard label, and texts containing any of the regex patterns, to the handler
+
+        Patterns are searched in the normalized (upper-case) text.
+        """
+        def register(handler):
+            self._exact[self.normalize(label)] = handler
+            self.buttons.append(label)
+            self.labels[handler] = label
+            for pattern in patterns:
+                self._pattern_handlers.append(handler)
+                self._pattern_sources.append(f"(?P<p{len(self._pattern_sources)}>{pattern})")
+            self._combined = re.compile("|".join(self._pattern_sources)) if self._pattern_sources else None
+            return handler
+        return register
+
+    def resolve(self, text):
+        """Handler for text, or None"""
+        key = self.normalize(text)
+        handler = self._exact.get(key)
+        if handler is None and self._combined is not None:
+            match = self._combined.search(key)
+            if match:
+                handler = self._pattern_handlers[int(match.lastgroup[1:])]
+        return handler
@@ -0,0 +1,228 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import STORAGE_SECONDS
+from storage import ADMIN_RELOAD_INTERVAL, SCAN_LIMIT, UserRegistry
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    joined_at INTEGER NOT NULL DEFAULT 0,
+    active INTEGER NOT NULL DEFAULT 1
+);
+CREATE TABLE IF NOT EXISTS admins (
+    user_id INTEGER PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+INSERT OR IGNORE INTO counters (name, value) VALUES ('users', 0);
+INSERT OR IGNORE INTO counters (name, value) VALUES ('active_users', 0);
+-- Keep user counts in counter rows so counting never scans the table
+CREATE TRIGGER IF NOT EXISTS users_count_insert AFTER INSERT ON users BEGIN
+    UPDATE counters SET value = value + 1 WHERE name = 'users';
+    UPDATE counters SET value = value + NEW.active WHERE name = 'active_users';
+END;
+CREATE TRIGGER IF NOT EXISTS users_count_delete AFTER DELETE ON users BEGIN
+    UPDATE counters SET value = value - 1 WHERE name = 'users';
+    UPDATE counters SET value = value - OLD.active WHERE name = 'active_users';
+END;
+CREATE TRIGGER IF NOT EXISTS users_count_active AFTER UPDATE OF active ON users BEGIN
+    UPDATE counters SET value = value + NEW.active - OLD.active WHERE name = 'active_users';
+END;
+"""
+
+
+class SqliteStorage:
+    """SQLite storage backend (WAL mode, one connection owned by one worker thread)"""
+
+    def __init__(self, data_dir, legacy_json=None):
+        self.data_dir = data_dir
+        self.db_path = os.path.join(data_dir, "rolex9.db")
+        self.legacy_json = legacy_json
+        # A single worker thread owns the connection, so every query runs
+        # off the event loop and SQLite never sees concurrent use
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self._conn = None
+        # Cached admin set; lookups never touch the database
+        self.admins = frozenset()
+        self._data_version = None
+        self._watcher = None
+
+    @staticmethod
+    def _timed(fn, *args):
+        with STORAGE_SECONDS.time(backend="sqlite", operation=fn.__name__.lstrip("_")):
+            return fn(*args)
+
+    async def _run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._timed, fn, *args)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        # Durable across process crashes; only an OS crash can lose the last commits
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(SCHEMA)
+        conn.commit()
+        self._conn = conn
+        self._import_files()
+
+    def _import_files(self):
+        """One-shot import of the file backend's users and admins.json"""
+        conn = self._conn
+        if conn.execute("SELECT 1 FROM meta WHERE key = 'files_imported'").fetchone():
+            return
+        registry = UserRegistry(self.data_dir, legacy_json=self.legacy_json)
+        registry.load()
+        users = registry.items()
+        inactive = registry.inactive_snapshot()
+        admins = []
+        admins_path = os.path.join(self.data_dir, "admins.json")
+        if os.path.exists(admins_path):
+            try:
+                with open(admins_path, 'r') as f:
+                    admins = json.load(f).get("admins", [])
+            except (json.JSONDecodeError, IOError, AttributeError) as e:
+                logger.error("Could not import %s: %s", admins_path, e)
+        with conn:
+            conn.executemany("INSERT OR IGNORE INTO users (user_id, joined_at) VALUES (?, ?)", users)
+            conn.executemany("UPDATE users SET active = 0 WHERE user_id = ?", [(u,) for u in inactive])
+            conn.executemany("INSERT OR IGNORE INTO admins (user_id) VALUES (?)", [(a,) for a in admins])
+            conn.execute(
+                "INSERT INTO meta (key, value) VALUES ('files_imported', ?)",
+                (str(int(time.time())),)
+            )
+        logger.info("Imported %s users and %s admins into %s", len(users), len(admins), self.db_path)
+
+    async def open(self):
+        await self._run(self._connect)
+        await self._run(self._reload_admins_if_changed)
+        self._watcher = asyncio.create_task(self._watch_admins())
+
+    async def close(self):
+        if self._watcher:
+            self._watcher.cancel()
+            self._watcher = None
+        if self._conn is not None:
+            await self._run(self._conn.close)
+            self._conn = None
+        self._executor.shutdown(wait=True)
+
+    def _add_user(self, user_id):
+        with self._conn:
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO users (user_id, joined_at) VALUES (?, ?)",
+                (user_id, int(time.time()))
+            )
+            if cursor.rowcount > 0:
+                return True
+            # Known user sending /start again: reachable again if they were inactive
+            self._conn.execute("UPDATE users SET active = 1 WHERE user_id = ? AND active = 0", (user_id,))
+        return False
+
+    async def add_user(self, user_id):
+        return await self._run(self._add_user, user_id)
+
+    def _count_users(self):
+        return self._conn.execute("SELECT value FROM counters WHERE name = 'users'").fetchone()[0]
+
+    async def count_users(self):
+        return await self._run(self._count_users)
+
+    def _count_active_users(self):
+        return self._conn.execute("SELECT value FROM counters WHERE name = 'active_users'").fetchone()[0]
+
+    async def count_active_users(self):
+        return await self._run(self._count_active_users)
+
+    def _scan_users(self, after, limit, active, joined_since):
+        conditions, params = [], []
+        if after is not None:
+            conditions.append("user_id > ?")
+            params.append(after)
+        if active is not None:
+            conditions.append("active = ?")
+            params.append(int(active))
+        if joined_since is not None:
+            conditions.append("joined_at >= ?")
+            params.append(joined_since)
+        where = f"WHERE {' AND '.join(conditions)} " if conditions else ""
+        # Keyset paging on the primary key: every page is an index range scan
+        query = f"SELECT user_id FROM users {where}ORDER BY user_id LIMIT ?"
+        return [row[0] for row in self._conn.execute(query, (*params, limit))]
+
+    async def scan_users(self, after=None, limit=SCAN_LIMIT, active=True, joined_since=None):
+        return await self._run(self._scan_users, after, limit, active, joined_since)
+
+    def _user_rows(self, after, offset, limit):
+        columns = "SELECT user_id, joined_at, active FROM users"
+        if after is not None:
+            # Keyset paging for exports: an index range scan per page
+            query, params = f"{columns} WHERE user_id > ? ORDER BY user_id LIMIT ?", (after, limit)
+        else:
+            query, params = f"{columns} ORDER BY user_id LIMIT ? OFFSET ?", (limit, offset)
+        return [(user_id, joined_at, bool(active)) for user_id, joined_at, active in self._conn.execute(query, params)]
+
+    async def user_rows(self, after=None, offset=0, limit=SCAN_LIMIT):
+        return await self._run(self._user_rows, after, offset, limit)
+
+    def _mark_inactive(self, user_ids):
+        with self._conn:
+            self._conn.executemany(
+                "UPDATE users SET active = 0 WHERE user_id = ? AND active = 1",
+                [(user_id,) for user_id in user_ids]
+            )
+
+    async def mark_inactive(self, user_ids):
+        await self._run(self._mark_inactive, user_ids)
+
+    def _reload_admins_if_changed(self):
+        """Re-read admins if another connection wrote to the database"""
+        # data_version only changes on commits made by *other* connections
+        # (e.g. the sqlite3 shell on the volume); our own writes update the cache directly
+        version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+        if version == self._data_version:
+            return False
+        self.admins = frozenset(row[0] for row in self._conn.execute("SELECT user_id FROM admins"))
+        self._data_version = version
+        return True
+
+    async def _watch_admins(self):
+        """Background task: pick up admin changes made outside the bot"""
+        while True:
+            await asyncio.sleep(ADMIN_RELOAD_INTERVAL)
+            if await self._run(self._reload_admins_if_changed):
+                logger.info("Reloaded %s admins from %s", len(self.admins), self.db_path)
+
+    async def load_admins(self):
+        return sorted(self.admins)
+
+    def _add_admin(self, user_id):
+        with self._conn:
+            self._conn.execute("INSERT OR IGNORE INTO admins (user_id) VALUES (?)", (user_id,))
+        self.admins = self.admins | {user_id}
+
+    async def add_admin(self, user_id):
+        await self._run(self._add_admin, user_id)
+
+    def _remove_admin(self, user_id):
+        with self._conn:
+            cursor = self._conn.execute("DELETE FROM admins WHERE user_id = ?", (user_id,))
+        self.admins = self.admins - {user_id}
+        return cursor.rowcount > 0
+
+    async def remove_admin(self, user_id):
+        return await self._run(self._remove_admin, user_id)
@@ -0,0 +1,439 @@
+import asyncio
+import json
+import logging
+import os
+import struct
+import tempfile
+import threading
+import time
+from itertools import islice
+
+from metrics import STORAGE_SECONDS
+from userset import UserSet
+
+logger = logging.getLogger(__name__)
+
+# Default write-behind tuning (overridable from config.py)
+FLUSH_INTERVAL = 5.0
+FLUSH_BATCH = 100
+# Rewrite the snapshot once the log holds this many records
+COMPACT_THRESHOLD = 10000
+# How often the cached admin set is checked against the backing store
+ADMIN_RELOAD_INTERVAL = 2.0
+# Default number of user IDs returned per scan_users() call
+SCAN_LIMIT = 1000
+
+# On-disk format: users.snapshot is a UserSet in binary form (see
+# userset.py); users.log holds fixed-width records of changes since the
+# snapshot. Loading is "map the snapshot, replay the log" and compaction
+# writes the current state into a fresh snapshot and empties the log.
+# Fixed-width record: kind (1 byte), user ID, unix timestamp
+RECORD = struct.Struct("<Bqq")
+USER_ADDED = 1
+# Delivery failed permanently (blocked, deleted account...); skipped by mailings
+USER_INACTIVE = 2
+# An inactive user sent /start again
+USER_ACTIVE = 3
+
+
+def atomic_write(path, data):
+    """Write bytes to path atomically (temp file + fsync + rename)"""
+    directory, name = os.path.split(os.path.abspath(path))
+    # A temp file of its own per call, so concurrent writes never share one
+    fd, tmp_path = tempfile.mkstemp(prefix=f"{name}.", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+    # Persist the rename itself
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+class UserRegistry:
+    """In-memory user registry backed by an append-only log and a snapshot
+
+    Users live in a UserSet (sorted flat arrays). The snapshot is the
+    UserSet's binary form, memory-mapped at startup; the log holds
+    changes since the snapshot and is replayed on top of it.
+    """
+
+    def __init__(self, data_dir, legacy_json=None, flush_interval=FLUSH_INTERVAL,
+                 flush_batch=FLUSH_BATCH, compact_threshold=COMPACT_THRESHOLD):
+        self.snapshot_path = os.path.join(data_dir, "users.snapshot")
+        self.log_path = os.path.join(data_dir, "users.log")
+        self.legacy_json = legacy_json
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self.compact_threshold = compact_threshold
+        # User IDs, join times (0 when unknown, e.g. migrated users) and inactive flags
+        self._users = UserSet()
+        self._pending = []
+        self._log_records = 0
+        # Guards state against the flush running in a worker thread
+        self._lock = threading.Lock()
+        # Serializes flushes so log appends and compactions never interleave
+        self._flush_lock = threading.Lock()
+        self._flush_wanted = asyncio.Event()
+        self._loaded = False
+
+    @staticmethod
+    def _replay(data, users):
+        """Apply log records from data to the UserSet, return number of whole records"""
+        count = len(data) // RECORD.size
+        for kind, user_id, ts in RECORD.iter_unpack(data[:count * RECORD.size]):
+            if kind == USER_ADDED:
+                users.add(user_id, ts)
+            elif kind == USER_INACTIVE:
+                users.set_inactive(user_id, True)
+            elif kind == USER_ACTIVE:
+                users.set_inactive(user_id, False)
+        return count
+
+    def _migrate_legacy(self):
+        """Import the old user_stats.json into a first snapshot
+
+        Raises ValueError if the file cannot be read or does not hold a
+        list of user IDs: starting without them would write a snapshot
+        and never look at the old file again, losing every user in it.
+        """
+        try:
+            with open(self.legacy_json, 'r') as f:
+                data = json.load(f)
+            user_ids = data.get("users", []) if isinstance(data, dict) else None
+            if not isinstance(user_ids, list):
+                raise ValueError('expected {"users": [user IDs, ...]}')
+            users = UserSet.from_pairs({int(uid): 0 for uid in user_ids}.items())
+        except (OSError, ValueError, TypeError) as e:
+            # Left in place for inspection; nothing is written until it migrates
+            raise ValueError(f"Could not migrate {self.legacy_json} (fix or move it, then restart): {e}") from e
+        atomic_write(self.snapshot_path, users.to_bytes())
+        os.replace(self.legacy_json, f"{self.legacy_json}.migrated")
+        logger.info("Migrated %s users from %s", len(users), self.legacy_json)
+        return users
+
+    def load(self):
+        """Load users from snapshot and log (once, at startup)"""
+        with STORAGE_SECONDS.time(backend="file", operation="load"):
+            self._load()
+
+    def _load(self):
+        users = UserSet()
+        log_records = 0
+        if os.path.exists(self.snapshot_path):
+            users = UserSet.load(self.snapshot_path)
+        elif self.legacy_json and os.path.exists(self.legacy_json):
+            users = self._migrate_legacy()
+        if os.path.exists(self.log_path):
+            with open(self.log_path, 'rb') as f:
+                data = f.read()
+            log_records = self._replay(memoryview(data), users)
+            if len(data) % RECORD.size:
+                # Torn tail from a crash mid-append: drop the partial record
+                logger.warning("Truncating partial record at end of %s", self.log_path)
+                with open(self.log_path, 'r+b') as f:
+                    f.truncate(log_records * RECORD.size)
+        users.merge()
+        with self._lock:
+            self._users = users
+            self._pending = []
+            self._log_records = log_records
+            self._loaded = True
+        logger.info("Loaded %s users, %s inactive (%s log records)", len(users), users.inactive_count, log_records)
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            self.load()
+
+    def _append(self, kind, user_id, ts):
+        # Caller holds self._lock
+        self._pending.append(RECORD.pack(kind, user_id, ts))
+        if len(self._pending) >= self.flush_batch:
+            self._flush_wanted.set()
+
+    def add(self, user_id):
+        """Add user ID, return True if it was not known yet
+
+        A known but inactive user is reactivated (they came back with /start).
+        """
+        self._ensure_loaded()
+        now = int(time.time())
+        with self._lock:
+            if self._users.add(user_id, now):
+                self._append(USER_ADDED, user_id, now)
+                return True
+            if self._users.set_inactive(user_id, False):
+                self._append(USER_ACTIVE, user_id, now)
+        return False
+
+    def mark_inactive(self, user_ids):
+        """Mark users as unreachable so mailings skip them"""
+        self._ensure_loaded()
+        now = int(time.time())
+        with self._lock:
+            for user_id in user_ids:
+                if self._users.set_inactive(user_id, True):
+                    self._append(USER_INACTIVE, user_id, now)
+
+    def active_count(self):
+        self._ensure_loaded()
+        return len(self._users) - self._users.inactive_count
+
+    def inactive_snapshot(self):
+        """Return a list copy of all inactive user IDs"""
+        self._ensure_loaded()
+        with self._lock:
+            users = self._users
+            users.merge()
+            return [user_id for user_id, flag in zip(users.ids, users.flags) if flag]
+
+    def scan(self, after=None, limit=SCAN_LIMIT, active=True, joined_since=None):
+        """Up to `limit` user IDs greater than `after`, in ascending order
+
+        active selects active (True), inactive (False) or all (None) users;
+        joined_since (unix time) skips users who joined earlier, including
+        those whose join time is unknown.
+        """
+        self._ensure_loaded()
+        result = []
+        with self._lock:
+            for user_id, joined, flag in self._users.iter_from(after):
+                if len(result) >= limit:
+                    break
+                if (active is None or flag != active) and (joined_since is None or joined >= joined_since):
+                    result.append(user_id)
+        return result
+
+    def rows(self, after=None, offset=0, limit=SCAN_LIMIT):
+        """Up to `limit` (user ID, joined timestamp, active) tuples in ID order
+
+        Starts after the user ID `after` if given, else skips `offset` users.
+        """
+        self._ensure_loaded()
+        with self._lock:
+            rows = islice(self._users.iter_from(after, offset), limit)
+            return [(user_id, joined, not flag) for user_id, joined, flag in rows]
+
+    def __contains__(self, user_id):
+        self._ensure_loaded()
+        with self._lock:
+            return user_id in self._users
+
+    def __len__(self):
+        self._ensure_loaded()
+        return len(self._users)
+
+    def items(self):
+        """Return a list of (user ID, joined timestamp) pairs"""
+        self._ensure_loaded()
+        with self._lock:
+            self._users.merge()
+            return list(zip(self._users.ids, self._users.joined))
+
+    def compact(self):
+        """Write current state to a new snapshot and truncate the log"""
+        with self._flush_lock:
+            with self._lock:
+                # One copy of the arrays; the slow write happens outside the lock
+                data = self._users.to_bytes()
+                count = len(self._users)
+                # The snapshot covers these, so they need no log record
+                records = self._pending
+                self._pending = []
+            try:
+                with STORAGE_SECONDS.time(backend="file", operation="compact"):
+                    atomic_write(self.snapshot_path, data)
+            except OSError as e:
+                # The old snapshot and log are intact; keep the records for them
+                with self._lock:
+                    self._pending = records + self._pending
+                logger.error("Could not write %s: %s", self.snapshot_path, e)
+                return False
+            # Once the snapshot is durable the log is redundant; if we crash
+            # before truncating, replaying it again is harmless
+            try:
+                with open(self.log_path, 'wb') as f:
+                    os.fsync(f.fileno())
+            except OSError as e:
+                logger.error("Could not truncate %s: %s", self.log_path, e)
+                return False
+            self._log_records = 0
+        logger.info("Compacted user log into snapshot (%s users)", count)
+        return True
+
+    def flush(self):
+        """Append pending users to the log, compacting when it grows large"""
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return False
+                records = self._pending
+                self._pending = []
+            try:
+                with STORAGE_SECONDS.time(backend="file", operation="flush"), open(self.log_path, 'ab') as f:
+                    f.write(b"".join(records))
+                    f.flush()
+                    os.fsync(f.fileno())
+            except IOError as e:
+                # Keep the records pending so the next flush retries them
+                with self._lock:
+                    self._pending = records + self._pending
+                logger.error("Could not append to %s: %s", self.log_path, e)
+                return False
+            self._log_records += len(records)
+        if self._log_records >= self.compact_threshold:
+            self.compact()
+        return True
+
+    async def run_flusher(self):
+        """Background task: flush pending users on a timer or batch threshold"""
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_wanted.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_wanted.clear()
+            try:
+                await asyncio.to_thread(self.flush)
+            except Exception:
+                # Keep flushing; whatever failed stays pending for the next round
+                logger.exception("User flush failed")
+
+
+class FileStorage:
+    """Default storage backend: user registry files plus admins.json"""
+
+    def __init__(self, data_dir, legacy_json=None, flush_interval=FLUSH_INTERVAL,
+                 flush_batch=FLUSH_BATCH):
+        self.users = UserRegistry(
+            data_dir,
+            legacy_json=legacy_json,
+            flush_interval=flush_interval,
+            flush_batch=flush_batch
+        )
+        self.admins_path = os.path.join(data_dir, "admins.json")
+        # Cached admin set; lookups never touch the disk
+        self.admins = frozenset()
+        self._admins_mtime = None
+        # Serializes read-modify-write of admins.json
+        self._admins_lock = asyncio.Lock()
+        self._tasks = []
+
+    async def open(self):
+        """Load stored data and start the background flusher and admin watcher"""
+        await asyncio.to_thread(self.users.load)
+        await asyncio.to_thread(self._reload_admins_if_changed)
+        self._tasks = [
+            asyncio.create_task(self.users.run_flusher()),
+            asyncio.create_task(self._watch_admins()),
+        ]
+
+    async def close(self):
+        """Stop background tasks and flush pending users"""
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        await asyncio.to_thread(self.users.flush)
+
+    async def add_user(self, user_id):
+        return self.users.add(user_id)
+
+    async def count_users(self):
+        return len(self.users)
+
+    async def count_active_users(self):
+        return self.users.active_count()
+
+    async def scan_users(self, after=None, limit=SCAN_LIMIT, active=True, joined_since=None):
+        return self.users.scan(after, limit, active, joined_since)
+
+    async def user_rows(self, after=None, offset=0, limit=SCAN_LIMIT):
+        return self.users.rows(after, offset, limit)
+
+    async def mark_inactive(self, user_ids):
+        self.users.mark_inactive(user_ids)
+
+    def _read_admins(self):
+        with STORAGE_SECONDS.time(backend="file", operation="read_admins"):
+            return self._read_admins_file()
+
+    def _read_admins_file(self):
+        if os.path.exists(self.admins_path):
+            try:
+                with open(self.admins_path, 'r') as f:
+                    data = json.load(f)
+                    if "admins" in data and isinstance(data["admins"], list):
+                        return data["admins"]
+            except (json.JSONDecodeError, IOError):
+                pass
+        return []
+
+    def _admins_file_mtime(self):
+        try:
+            return os.stat(self.admins_path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _reload_admins_if_changed(self):
+        """Re-read admins.json if it changed on disk, return True if reloaded"""
+        # Take the mtime before reading so an edit racing the read is seen next time
+        mtime = self._admins_file_mtime()
+        if mtime == self._admins_mtime:
+            return False
+        self.admins = frozenset(self._read_admins())
+        self._admins_mtime = mtime
+        return True
+
+    def _write_admins(self, admins):
+        with STORAGE_SECONDS.time(backend="file", operation="write_admins"):
+            atomic_write(self.admins_path, json.dumps({"admins": sorted(admins)}).encode())
+        self.admins = frozenset(admins)
+        self._admins_mtime = self._admins_file_mtime()
+
+    async def _watch_admins(self):
+        """Background task: pick up manual edits of admins.json on the volume"""
+        while True:
+            await asyncio.sleep(ADMIN_RELOAD_INTERVAL)
+            async with self._admins_lock:
+                if await asyncio.to_thread(self._reload_admins_if_changed):
+                    logger.info("Reloaded %s admins from %s", len(self.admins), self.admins_path)
+
+    async def load_admins(self):
+        return sorted(self.admins)
+
+    async def add_admin(self, user_id):
+        async with self._admins_lock:
+            # Start from the file's latest content so manual edits are not lost
+            await asyncio.to_thread(self._reload_admins_if_changed)
+            if user_id not in self.admins:
+                await asyncio.to_thread(self._write_admins, self.admins | {user_id})
+
+    async def remove_admin(self, user_id):
+        async with self._admins_lock:
+            await asyncio.to_thread(self._reload_admins_if_changed)
+            if user_id not in self.admins:
+                return False
+            await asyncio.to_thread(self._write_admins, self.admins - {user_id})
+            return True
+
+
+def open_storage(backend, data_dir, legacy_json=None, **file_options):
+    """Create the storage backend selected by STORAGE_BACKEND"""
+    if backend == "sqlite":
+        # Imported lazily so the file backend never loads sqlite3
+        from sqlite_storage import SqliteStorage
+        return SqliteStorage(data_dir, legacy_json=legacy_json)
+    if backend == "file":
+        return FileStorage(data_dir, legacy_json=legacy_json, **file_options)
+    raise ValueError(f"Unknown STORAGE_BACKEND: {backend!r} (expected 'file' or 'sqlite')")
@@ -0,0 +1,335 @@
+"""Benchmark the bot's handlers and mailings against the fake Bot API
+
+Starts tools/fake_bot_api.py, then for every user count runs the bot's
+real handlers in a fresh process with its own DATA_DIR:
+
+    python tools/benchmark.py --users 1000,10000,100000 --updates 1000
+    python tools/benchmark.py --users 10000 --latency 40 --jitter 20 --forbidden-ratio 0.05
+
+Each run seeds the user store, then measures /start (new users), the two
+promo buttons, /mailing as a reply and a forwarded post. Handler rows show
+p50/p99 latency and disk bytes read/written per update (from
+/proc/self/io, so Linux only); mailing rows show how fast the job reached
+every user. Mailings run with --broadcast-rate, which defaults to
+effectively unlimited so the bot's own overhead is what gets measured.
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from tools.fake_bot_api import SEND_METHODS, FakeBotAPI, add_arguments  # noqa: E402
+
+ADMIN_ID = 1000
+# Seeded users get IDs from here up; /start is measured with IDs above NEW_USER_BASE
+USER_BASE = 10_000_000
+NEW_USER_BASE = 90_000_000
+CHANNEL_ID = -1001234567890
+FREE_SPIN_TEXT = "GET FREE SPIN ON ROLEX9 🎰"
+HOT_GAME_TIPS_TEXT = "HOT GAME TIPS CHANNEL 🍒"
+MAILING_TEXT = "🎉 Weekend reload bonus is live! Claim it before Sunday midnight."
+
+
+def message_update(user_id, text, **extra):
+    """Update dict for a private message from user_id"""
+    message = {
+        "message_id": 1,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private", "first_name": "Bench"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "Bench"},
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    message.update(extra)
+    return {"update_id": 1, "message": message}
+
+
+def disk_io():
+    """(read_bytes, write_bytes) this process caused at the storage layer, or None"""
+    try:
+        with open("/proc/self/io") as f:
+            fields = dict(line.split(": ") for line in f.read().splitlines())
+    except OSError:
+        return None
+    return int(fields["read_bytes"]), int(fields["write_bytes"])
+
+
+def io_delta(before, after):
+    if before is None or after is None:
+        return None, None
+    return after[0] - before[0], after[1] - before[1]
+
+
+def fake_stats(api_url):
+    with urllib.request.urlopen(f"{api_url}/_fake/stats") as response:
+        return json.load(response)
+
+
+def percentile(sorted_values, p):
+    if len(sorted_values) == 1:
+        return sorted_values[0]
+    return statistics.quantiles(sorted_values, n=100)[p - 1]
+
+
+async def measure_handler(application, name, updates, settle=0.0):
+    """Feed updates through the application one by one, timing each"""
+    from telegram import Update
+
+    updates = [Update.de_json(update, application.bot) for update in updates]
+    latencies = []
+    io_before = disk_io()
+    started = time.perf_counter()
+    for update in updates:
+        update_started = time.perf_counter()
+        await application.process_update(update)
+        latencies.append(time.perf_counter() - update_started)
+    elapsed = time.perf_counter() - started
+    # Let write-behind storage flush, so its I/O is counted for this handler
+    await asyncio.sleep(settle)
+    read, written = io_delta(io_before, disk_io())
+    latencies.sort()
+    return {
+        "handler": name,
+        "updates": len(updates),
+        "per_sec": len(updates) / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "read_per_update": None if read is None else read / len(updates),
+        "written_per_update": None if written is None else written / len(updates),
+    }
+
+
+async def measure_mailing(application, bot, name, update, api_url):
+    """Run one mailing handler and wait until its job has reached every recipient"""
+    from telegram import Update
+    from broadcast_jobs import CANCELLED, DONE
+
+    known_jobs = set(bot.job_manager.jobs)
+    stats_before = await asyncio.to_thread(fake_stats, api_url)
+    io_before = disk_io()
+    started = time.perf_counter()
+    await application.process_update(Update.de_json(update, application.bot))
+    handler_latency = time.perf_counter() - started
+    new_jobs = [job for job_id, job in bot.job_manager.jobs.items() if job_id not in known_jobs]
+    if not new_jobs:
+        return {"mailing": name, "recipients": 0, "error": "no job was started"}
+    job = new_jobs[0]
+    total = job.meta["total"]
+    # Jobs are queued first and start when the scheduler gets to them
+    while job.status not in (DONE, CANCELLED):
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - started
+    read, written = io_delta(io_before, disk_io())
+    stats_after = await asyncio.to_thread(fake_stats, api_url)
+    errors = {
+        code: stats_after["errors"][code] - stats_before["errors"].get(code, 0)
+        for code in stats_after["errors"]
+    }
+    send_calls = sum(
+        stats_after["calls"].get(method, 0) - stats_before["calls"].get(method, 0) for method in SEND_METHODS
+    )
+    return {
+        "mailing": name,
+        "recipients": total,
+        "handler_ms": handler_latency * 1000,
+        "seconds": elapsed,
+        "per_sec": total / elapsed,
+        "sent": job.meta.get("counts", {}).get("sent"),
+        "unreachable": job.meta.get("counts", {}).get("unreachable"),
+        "http_429": errors.get("429", 0),
+        "http_403": errors.get("403", 0),
+        "calls_per_message": send_calls / total,
+        "strategy": job.meta.get("strategy"),
+        "written_per_message": None if written is None else written / total,
+    }
+
+
+async def run_child(users, samples, api_url, forbidden_ratio):
+    """Benchmark one user count; runs in its own process (bot.py is configured at import)"""
+    import logging
+    import bot
+    from config import USER_FLUSH_INTERVAL
+
+    logging.getLogger().setLevel(logging.WARNING)
+    application = bot.build_application()
+    await application.initialize()
+    await bot.post_init(application)
+    try:
+        for i in range(users):
+            await bot.storage.add_user(USER_BASE + i)
+        await bot.storage.add_admin(ADMIN_ID)
+        await asyncio.sleep(USER_FLUSH_INTERVAL + 0.5)
+
+        # Users who message the bot have not blocked it, so handlers only see reachable users
+        blocked = FakeBotAPI(forbidden_ratio=forbidden_ratio).is_forbidden
+        existing = [user_id for user_id in range(USER_BASE, USER_BASE + users) if not blocked(user_id)]
+        existing = existing[::max(1, len(existing) // samples)][:samples]
+        new_users = [user_id for user_id in range(NEW_USER_BASE, NEW_USER_BASE + 2 * samples)
+                     if not blocked(user_id)][:samples]
+        handlers = [
+            await measure_handler(
+                application, "/start",
+                [message_update(user_id, "/start") for user_id in new_users],
+                settle=USER_FLUSH_INTERVAL + 0.5
+            ),
+            await measure_handler(
+                application, "free spin",
+                [message_update(user_id, FREE_SPIN_TEXT) for user_id in existing]
+            ),
+            await measure_handler(
+                application, "hot game tips",
+                [message_update(user_id, HOT_GAME_TIPS_TEXT) for user_id in existing]
+            ),
+        ]
+        post = {"message_id": 7, "date": int(time.time()), "chat": {"id": ADMIN_ID, "type": "private"},
+                "text": MAILING_TEXT}
+        mailings = [
+            await measure_mailing(
+                application, bot, "/mailing (reply)",
+                message_update(ADMIN_ID, "/mailing", reply_to_message=post), api_url
+            ),
+            await measure_mailing(
+                application, bot, "forwarded post",
+                message_update(
+                    ADMIN_ID, MAILING_TEXT,
+                    forward_from_chat={"id": CHANNEL_ID, "type": "channel", "title": "Rolex9"},
+                    forward_from_message_id=42, forward_date=int(time.time())
+                ),
+                api_url
+            ),
+        ]
+    finally:
+        await bot.post_stop(application)
+        await bot.post_shutdown(application)
+        await application.shutdown()
+    return {"users": users, "handlers": handlers, "mailings": mailings}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_fake_api(args):
+    port = free_port()
+    command = [sys.executable, os.path.join(ROOT, "tools", "fake_bot_api.py"), "--port", str(port)]
+    for option in ("latency", "jitter", "rate_limit", "retry_after", "retry_after_ratio",
+                   "forbidden_ratio", "seed"):
+        value = getattr(args, option)
+        if value is not None:
+            command += [f"--{option.replace('_', '-')}", str(value)]
+    if args.protected_content:
+        command.append("--protected-content")
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    api_url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            fake_stats(api_url)
+            return process, api_url
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("fake Bot API did not start")
+
+
+def format_bytes(value):
+    return "n/a" if value is None else f"{value:.0f}"
+
+
+def print_results(result):
+    users = result["users"]
+    print(f"\n== {users} users ==")
+    print(f"{'handler':<16} {'updates':>7} {'upd/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'disk rd B/upd':>14} {'disk wr B/upd':>14}")
+    for row in result["handlers"]:
+        print(
+            f"{row['handler']:<16} {row['updates']:>7} {row['per_sec']:>8.1f} {row['p50_ms']:>8.2f} "
+            f"{row['p99_ms']:>8.2f} {format_bytes(row['read_per_update']):>14} "
+            f"{format_bytes(row['written_per_update']):>14}"
+        )
+    print(
+        f"{'mailing':<16} {'recip.':>7} {'msgs/s':>8} {'seconds':>8} {'handler ms':>10} {'429s':>6} {'403s':>6} "
+        f"{'calls/msg':>9} {'disk wr B/msg':>14}  strategy"
+    )
+    for row in result["mailings"]:
+        if "error" in row:
+            print(f"{row['mailing']:<16} {row['error']}")
+            continue
+        print(
+            f"{row['mailing']:<16} {row['recipients']:>7} {row['per_sec']:>8.1f} {row['seconds']:>8.2f} "
+            f"{row['handler_ms']:>10.2f} {row['http_429']:>6} {row['http_403']:>6} "
+            f"{row['calls_per_message']:>9.2f} {format_bytes(row['written_per_message']):>14}  {row['strategy']}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", default="1000,10000,100000", help="Comma-separated user counts to benchmark")
+    parser.add_argument("--updates", type=int, default=1000, help="Updates measured per handler")
+    parser.add_argument("--storage", choices=("file", "sqlite"), default="file", help="STORAGE_BACKEND to use")
+    parser.add_argument("--broadcast-rate", type=float, default=1_000_000, help="BROADCAST_RATE for mailings")
+    parser.add_argument("--workers", type=int, default=None, help="BROADCAST_WORKERS (default: bot's default)")
+    parser.add_argument("--json", help="Also write the raw results to this file")
+    parser.add_argument("--child-users", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--api-url", help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", help=argparse.SUPPRESS)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.child_users is not None:
+        result = asyncio.run(run_child(args.child_users, args.updates, args.api_url, args.forbidden_ratio))
+        with open(args.result_file, 'w', encoding='utf-8') as f:
+            json.dump(result, f)
+        return
+
+    process, api_url = start_fake_api(args)
+    results = []
+    try:
+        for users in (int(n) for n in args.users.split(",")):
+            with tempfile.TemporaryDirectory(prefix="rolex9-bench-") as data_dir:
+                env = dict(
+                    os.environ,
+                    DATA_DIR=data_dir,
+                    BOT_TOKEN="123456:benchmark",
+                    BOT_MODE="polling",
+                    BOT_API_BASE_URL=api_url,
+                    STORAGE_BACKEND=args.storage,
+                    BROADCAST_RATE=str(args.broadcast_rate),
+                    PROMO_WARMUP_CHAT_ID="",
+                )
+                if args.workers:
+                    env["BROADCAST_WORKERS"] = str(args.workers)
+                print(f"Benchmarking {users} users...", file=sys.stderr)
+                result_file = os.path.join(data_dir, "result.json")
+                # The bot logs to stdout; keep it apart from the results table
+                subprocess.run(
+                    [sys.executable, os.path.abspath(__file__), "--child-users", str(users),
+                     "--updates", str(args.updates), "--api-url", api_url,
+                     "--forbidden-ratio", str(args.forbidden_ratio), "--result-file", result_file],
+                    cwd=ROOT, env=env, check=True, stdout=sys.stderr
+                )
+                with open(result_file, 'r', encoding='utf-8') as f:
+                    result = json.load(f)
+                results.append(result)
+                print_results(result)
+    finally:
+        process.terminate()
+        process.wait()
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+"""Local stand-in for the Telegram Bot API
+
+Answers the methods the bot calls with plausible results, so the bot can
+run without Telegram:
+
+    python tools/fake_bot_api.py --port 8081
+    BOT_API_BASE_URL=http://127.0.0.1:8081 python bot.py
+
+It can also behave like a busy Telegram: add latency to every call, answer
+429 with retry_after when sends exceed a rate (or at random), and answer
+403 Forbidden for a share of users, as if they had blocked the bot:
+
+    python tools/fake_bot_api.py --latency 40 --jitter 20 --rate-limit 30 --forbidden-ratio 0.05
+
+With --protected-content, forwardMessage and copyMessage fail with 400 as
+they do for posts from a channel with content protection.
+
+getUpdates long-polls like the real one. Updates are injected with
+POST /_fake/updates (one Update object or a list), and GET /_fake/stats
+returns call counters.
+"""
+import argparse
+import asyncio
+import email.parser
+import itertools
+import json
+import logging
+import os
+import random
+import sys
+import time
+import zlib
+from urllib.parse import parse_qs
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from httpserver import HTTPServer, Response  # noqa: E402
+
+logger = logging.getLogger("fake_bot_api")
+
+BOT_USER = {"id": 1000000001, "is_bot": True, "first_name": "Rolex9 Promo Bot", "username": "rolex9_fake_bot"}
+# Methods that deliver a message to chat_id, and so can hit the rate limit or a blocked user
+SEND_METHODS = {"sendMessage", "sendPhoto", "sendVideo", "sendDocument", "forwardMessage", "copyMessage"}
+# Longest getUpdates wait we honour, whatever timeout the client asks for
+MAX_POLL_TIMEOUT = 50
+
+
+def parse_params(request):
+    """Decode Bot API parameters sent as JSON, form-urlencoded or multipart"""
+    content_type = request.headers.get("content-type", "")
+    if content_type.startswith("application/json"):
+        return request.json() or {}
+    if content_type.startswith("multipart/form-data"):
+        message = email.parser.BytesParser().parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode() + request.body
+        )
+        params = {}
+        for part in message.get_payload():
+            name = part.get_param("name", header="content-disposition")
+            if part.get_filename() is None:
+                params[name] = part.get_payload(decode=True).decode()
+            else:
+                params[name] = f"<upload {part.get_filename()}>"
+        return params
+    return {k: v[-1] for k, v in parse_qs(request.body.decode()).items()}
+
+
+def error(status, description, **parameters):
+    body = {"ok": False, "error_code": status, "description": description}
+    if parameters:
+        body["parameters"] = parameters
+    return Response.json(body, status=status)
+
+
+class FakeBotAPI:
+    """In-memory fake of the Bot API methods used by the bot
+
+    latency and jitter are in seconds. rate_limit caps sends per second
+    across all chats (0 = unlimited); retry_after_ratio additionally
+    answers that share of sends with 429 at random. Chats picked by
+    forbidden_ratio always answer 403, the same chats on every run.
+    protected_content makes every forward and copy fail with 400.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, rate_limit=0.0, retry_after=1,
+                 retry_after_ratio=0.0, forbidden_ratio=0.0, protected_content=False, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.retry_after_ratio = retry_after_ratio
+        self.forbidden_ratio = forbidden_ratio
+        self.protected_content = protected_content
+        self._random = random.Random(seed)
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+        self._update_ids = itertools.count(1)
+        # One-second window of accepted sends, for rate_limit
+        self._window_start = time.monotonic()
+        self._window_sends = 0
+        # Requests arriving before this time get 429 (Telegram's flood wait)
+        self._flood_until = 0.0
+        self._updates = []
+        self._updates_added = asyncio.Event()
+        self.calls = {}
+        self.errors = {"429": 0, "403": 0, "400": 0}
+
+    def is_forbidden(self, chat_id):
+        # A hash of the ID spreads the blocked users evenly over any ID range
+        return zlib.crc32(str(chat_id).encode()) % 10000 < self.forbidden_ratio * 10000
+
+    def _throttled(self):
+        """Return the retry_after to answer with, or None if the send may go through"""
+        now = time.monotonic()
+        if now < self._flood_until:
+            return max(1, round(self._flood_until - now))
+        if self.retry_after_ratio and self._random.random() < self.retry_after_ratio:
+            return self.retry_after
+        if self.rate_limit:
+            if now - self._window_start >= 1.0:
+                self._window_start = now
+                self._window_sends = 0
+            if self._window_sends >= self.rate_limit:
+                self._flood_until = now + self.retry_after
+                return self.retry_after
+            self._window_sends += 1
+        return None
+
+    def _message(self, params, **content):
+        chat_id = int(params.get("chat_id", 0))
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+        }
+        message.update(content)
+        return message
+
+    def _file(self, prefix):
+        n = next(self._file_ids)
+        return {"file_id": f"{prefix}{n}", "file_unique_id": f"u{prefix}{n}"}
+
+    def add_updates(self, updates):
+        """Queue updates for getUpdates, numbering them"""
+        for update in updates:
+            self._updates.append(dict(update, update_id=next(self._update_ids)))
+        self._updates_added.set()
+
+    async def get_updates(self, params):
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        timeout = min(float(params.get("timeout") or 0), MAX_POLL_TIMEOUT)
+        # Confirmed updates (below offset) are dropped, as Telegram does
+        self._updates = [u for u in self._updates if u["update_id"] >= offset]
+        if not self._updates and timeout:
+            self._updates_added.clear()
+            try:
+                await asyncio.wait_for(self._updates_added.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self._updates[:limit]
+
+    def result(self, method, params):
+        if method == "getMe":
+            return BOT_USER
+        if method == "sendMessage":
+            return self._message(params, text=params.get("text", ""))
+        if method == "sendPhoto":
+            photo = dict(self._file("photo"), width=640, height=640)
+            return self._message(params, photo=[photo], caption=params.get("caption"))
+        if method == "sendVideo":
+            video = dict(self._file("video"), width=640, height=360, duration=1)
+            return self._message(params, video=video, caption=params.get("caption"))
+        if method == "sendDocument":
+            return self._message(params, document=self._file("document"), caption=params.get("caption"))
+        if method == "forwardMessage":
+            return self._message(params, text="forwarded")
+        if method == "copyMessage":
+            return {"message_id": next(self._message_ids)}
+        # setWebhook, deleteWebhook, deleteMessage, editMessageText, ...
+        return True
+
+    async def handle(self, request):
+        method = request.path.rsplit("/", 1)[-1]
+        self.calls[method] = self.calls.get(method, 0) + 1
+        params = parse_params(request)
+        if method == "getUpdates":
+            return Response.json({"ok": True, "result": await self.get_updates(params)})
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + self._random.uniform(0, self.jitter))
+        if method in SEND_METHODS:
+            retry_after = self._throttled()
+            if retry_after is not None:
+                self.errors["429"] += 1
+                return error(429, f"Too Many Requests: retry after {retry_after}", retry_after=retry_after)
+            if self.is_forbidden(int(params.get("chat_id", 0))):
+                self.errors["403"] += 1
+                return error(403, "Forbidden: bot was blocked by the user")
+            if self.protected_content and method in ("forwardMessage", "copyMessage"):
+                self.errors["400"] += 1
+                action = "forwarded" if method == "forwardMessage" else "copied"
+                return error(400, f"Bad Request: message can't be {action}")
+        return Response.json({"ok": True, "result": self.result(method, params)})
+
+    async def inject(self, request):
+        updates = request.json()
+        self.add_updates(updates if isinstance(updates, list) else [updates])
+        return Response.json({"ok": True, "queued": len(self._updates)})
+
+    async def stats(self, request):
+        return Response.json({"calls": self.calls, "errors": self.errors})
+
+    def server(self):
+        # The bot token is part of every path, so all API requests go to one handler
+        server = HTTPServer(fallback=self.handle)
+        server.route("POST", "/_fake/updates", self.inject)
+        server.route("GET", "/_fake/stats", self.stats)
+        return server
+
+
+def add_arguments(parser):
+    """Options shared with tools that start the fake API themselves"""
+    parser.add_argument("--latency", type=float, default=0, help="Delay added to every call, in ms")
+    parser.add_argument("--jitter", type=float, default=0, help="Random extra delay of up to this many ms")
+    parser.add_argument("--rate-limit", type=float, default=0, help="Sends per second before answering 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after seconds sent with 429")
+    parser.add_argument("--retry-after-ratio", type=float, default=0, help="Share of sends answered with 429 at random")
+    parser.add_argument("--forbidden-ratio", type=float, default=0, help="Share of users that have blocked the bot")
+    parser.add_argument("--protected-content", action="store_true", help="Fail forwardMessage and copyMessage")
+    parser.add_argument("--seed", type=int, default=None, help="Seed for latency jitter and random 429s")
+
+
+def from_arguments(args):
+    return FakeBotAPI(
+        latency=args.latency / 1000,
+        jitter=args.jitter / 1000,
+        rate_limit=args.rate_limit,
+        retry_after=args.retry_after,
+        retry_after_ratio=args.retry_after_ratio,
+        forbidden_ratio=args.forbidden_ratio,
+        protected_content=args.protected_content,
+        seed=args.seed
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    add_arguments(parser)
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    api = from_arguments(args)
+    server = api.server()
+    await server.start(args.host, args.port)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        logger.info("Calls served: %s, errors: %s", json.dumps(api.calls), json.dumps(api.errors))
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
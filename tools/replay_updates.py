@@ -0,0 +1,94 @@
+"""Replay recorded Telegram Update JSON against the bot's webhook endpoint
+
+Runs the webhook mode end to end without Telegram:
+
+    python tools/fake_bot_api.py --port 8081 &
+    BOT_MODE=webhook BOT_API_BASE_URL=http://127.0.0.1:8081 WEBHOOK_SECRET=test \\
+        DATA_DIR=./data python bot.py &
+    python tools/replay_updates.py --secret test --repeat 100 --concurrency 8 tools/updates/*.json
+
+Each POST gets a fresh update_id and comes from the next of --users users
+(sender and private chat IDs rewritten), so the bot's per-user flood
+control lets the load through as it would real traffic. Prints status
+counts and p50/p99 latency.
+"""
+import argparse
+import http.client
+import json
+import statistics
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+from urllib.parse import urlsplit
+
+
+def with_user(value, user_id):
+    """Copy of an update (or part of one) with the sender and private chat set to user_id"""
+    if isinstance(value, list):
+        return [with_user(item, user_id) for item in value]
+    if not isinstance(value, dict):
+        return value
+    value = {key: with_user(item, user_id) for key, item in value.items()}
+    for key in ("from", "chat"):
+        # Not the bot's own messages (a callback query's message is from the bot)
+        peer = value.get(key)
+        if isinstance(peer, dict) and not peer.get("is_bot") and peer.get("type", "private") == "private":
+            peer["id"] = user_id
+    return value
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("files", nargs="+", help="Update JSON files to post")
+    parser.add_argument("--url", default="http://127.0.0.1:8080/telegram", help="Webhook endpoint")
+    parser.add_argument("--secret", default="", help="Value for X-Telegram-Bot-Api-Secret-Token")
+    parser.add_argument("--repeat", type=int, default=1, help="Post every file this many times")
+    parser.add_argument("--concurrency", type=int, default=1, help="Parallel connections")
+    parser.add_argument("--users", type=int, default=10000, help="Spread the posts over this many user IDs")
+    parser.add_argument("--first-user-id", type=int, default=555000001, help="Lowest user ID to post as")
+    args = parser.parse_args()
+
+    updates = []
+    for path in args.files:
+        with open(path, 'r', encoding='utf-8') as f:
+            updates.append(json.load(f))
+    work = [update for _ in range(args.repeat) for update in updates]
+
+    url = urlsplit(args.url)
+    headers = {"Content-Type": "application/json"}
+    if args.secret:
+        headers["X-Telegram-Bot-Api-Secret-Token"] = args.secret
+    update_ids = count(int(time.time()) * 1000)
+    posts = count()
+    local = threading.local()
+
+    def post(update):
+        # One keep-alive connection per worker thread
+        if not hasattr(local, "conn"):
+            local.conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=30)
+        user_id = args.first_user_id + next(posts) % args.users
+        body = json.dumps(dict(with_user(update, user_id), update_id=next(update_ids))).encode()
+        started = time.perf_counter()
+        local.conn.request("POST", url.path, body=body, headers=headers)
+        response = local.conn.getresponse()
+        response.read()
+        return response.status, time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(post, work))
+    elapsed = time.perf_counter() - started
+
+    statuses = Counter(status for status, _ in results)
+    latencies = sorted(latency for _, latency in results)
+    print(f"Posted {len(results)} updates in {elapsed:.2f}s ({len(results) / elapsed:.1f} updates/s)")
+    print(f"Status codes: {dict(statuses)}")
+    if len(latencies) > 1:
+        q = statistics.quantiles(latencies, n=100)
+        print(f"Latency p50: {q[49] * 1000:.1f} ms, p99: {q[98] * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+import asyncio
+import logging
+
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates concurrently, but strictly one after another within a chat
+
+    Different chats run in parallel up to max_concurrent_updates; updates
+    of the same chat wait for the previous one, so a user's button presses
+    are always handled in the order they were sent.
+
+    On shutdown, drain() waits for the updates already handed over and
+    cuts off whatever is still running when its timeout runs out.
+    """
+
+    def __init__(self, max_concurrent_updates, max_pending_updates=4096):
+        # The base class semaphore only bounds how many updates may be waiting;
+        # the real concurrency limit is taken *after* the chat lock (see below)
+        super().__init__(max(max_pending_updates, max_concurrent_updates))
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        # chat ID -> [lock, number of updates holding or waiting for it]
+        self._chat_locks = {}
+        # Updates handed to do_process_update and not finished (waiting or running)
+        self._active = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        # Tasks of the handlers running now, cancelled if drain() times out
+        self._running = set()
+        self._cut_off = False
+
+    @staticmethod
+    def _chat_key(update):
+        chat = getattr(update, "effective_chat", None)
+        if chat is not None:
+            return chat.id
+        user = getattr(update, "effective_user", None)
+        return user.id if user is not None else None
+
+    async def do_process_update(self, update, coroutine):
+        self._active += 1
+        self._idle.clear()
+        try:
+            await self._process(update, coroutine)
+        finally:
+            self._active -= 1
+            if not self._active:
+                self._idle.set()
+
+    async def _process(self, update, coroutine):
+        # Updates queued behind a slow one in the same chat wait on the chat
+        # lock without holding a concurrency slot that other chats need
+        key = self._chat_key(update)
+        if key is None:
+            await self._run(coroutine)
+            return
+        entry = self._chat_locks.get(key)
+        if entry is None:
+            entry = self._chat_locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await self._run(coroutine)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chat_locks[key]
+
+    async def _run(self, coroutine):
+        async with self._slots:
+            if self._cut_off:
+                # Shutdown deadline passed before this update's turn came
+                coroutine.close()
+                return
+            # A task of its own, so drain() can cancel the handler while the
+            # caller still returns normally (the update queue counts on that)
+            task = asyncio.ensure_future(coroutine)
+            self._running.add(task)
+            try:
+                await task
+            except asyncio.CancelledError:
+                if not (self._cut_off and task.cancelled()):
+                    raise
+            finally:
+                self._running.discard(task)
+
+    async def drain(self, timeout):
+        """Wait up to timeout seconds for all updates handed over so far
+
+        Whatever is still running then is cancelled and whatever is still
+        waiting is dropped, as is anything handed over later. Returns the
+        number of updates that did not finish.
+        """
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+            return 0
+        except asyncio.TimeoutError:
+            pass
+        self._cut_off = True
+        unfinished = self._active
+        for task in list(self._running):
+            task.cancel()
+        await self._idle.wait()
+        return unfinished
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
@@ -0,0 +1,66 @@
+import hmac
+import logging
+
+from telegram import Update
+
+from httpserver import HTTPServer, Response
+from lifecycle import run_application
+
+logger = logging.getLogger(__name__)
+
+
+def build_server(application, url_path, secret_token):
+    """HTTP server that feeds webhook updates into the application and serves a health check"""
+    server = HTTPServer()
+
+    async def receive_update(request):
+        if secret_token:
+            received = request.headers.get("x-telegram-bot-api-secret-token", "")
+            if not hmac.compare_digest(received, secret_token):
+                logger.warning("Rejected webhook request with a wrong secret token")
+                return Response(403, "forbidden")
+        try:
+            data = request.json()
+            # Valid JSON that is not an object (a list, null, a number) is not an update either
+            if not isinstance(data, dict):
+                raise ValueError(f"expected a JSON object, got {type(data).__name__}")
+            update = Update.de_json(data, application.bot)
+        except (ValueError, TypeError, KeyError) as e:
+            logger.warning("Rejected malformed webhook update: %s", e)
+            return Response(400, "bad update")
+        # Processing happens in the application's update loop, so Telegram gets
+        # its 200 right away and slow handlers never hold the HTTP connection
+        await application.update_queue.put(update)
+        return Response(200, "ok")
+
+    async def health(request):
+        return Response.json({"status": "ok", "running": application.running})
+
+    server.route("POST", f"/{url_path.strip('/')}", receive_update)
+    server.route("GET", "/healthz", health)
+    return server
+
+
+async def run_webhook(application, listen, port, url_path, webhook_url=None, secret_token=None,
+                      allowed_updates=None, deadline=None):
+    """Run the application in webhook mode until SIGINT/SIGTERM
+
+    Same lifecycle as polling (see lifecycle.run_application), but
+    updates come from our own HTTP server. When webhook_url is empty the
+    webhook is not registered with Telegram, which is how the local
+    replay harness runs.
+    """
+    server = build_server(application, url_path, secret_token)
+
+    async def start_server():
+        await server.start(listen, port)
+        if webhook_url:
+            await application.bot.set_webhook(
+                url=f"{webhook_url.rstrip('/')}/{url_path.strip('/')}",
+                secret_token=secret_token,
+                allowed_updates=allowed_updates,
+                max_connections=100
+            )
+            logger.info("Webhook registered at %s", webhook_url)
+
+    await run_application(application, start_server, server.stop, deadline)